@@ -1,50 +1,115 @@
-import threading
-from . import ems
+import os
+from . import ems, capture
 import logging
 import voluptuous as vol
-from homeassistant.const import CONF_DEVICE, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP
+from homeassistant.const import (
+    CONF_DEVICE, CONF_HOST, CONF_PORT, EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP)
+from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers import discovery
+from homeassistant.helpers.storage import Store
 
 PLATFORMS = ['sensor', 'binary_sensor']
 DOMAIN = 'buderus_ems'
 _LOGGER = logging.getLogger(__name__)
 EVENT_UPDATED = 'buderus_ems_received'
+CONF_SUMMARY_INTERVAL = 'summary_interval'
+CONF_CAPTURE = 'capture'
+CONF_THROTTLE = 'throttle'
+CONF_DEADBAND = 'deadband'
+CONF_RELATIVE_DEADBAND = 'relative_deadband'
+CONF_MIN_INTERVAL = 'min_interval'
+CONF_MAX_INTERVAL = 'max_interval'
+CONF_QUEUE_SIZE = 'queue_size'
+CONF_OVERFLOW = 'overflow'
+CONF_RESTORE = 'restore'
+
+# The decoded state is kept in .storage, so the entities have their values right after
+# a restart. It is written at most every STATE_SAVE_DELAY seconds.
+STORAGE_VERSION = 1
+STORAGE_KEY = DOMAIN + '.state'
+STATE_SAVE_DELAY = 60
+
+# Publishing limits of a sensor value, configured as <section>.<field>
+THROTTLE_SCHEMA = vol.Schema({
+    vol.Optional(CONF_DEADBAND, default=0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_RELATIVE_DEADBAND, default=0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_MIN_INTERVAL, default=0): cv.positive_int,
+    vol.Optional(CONF_MAX_INTERVAL, default=0): cv.positive_int,
+})
 
 CONFIG_SCHEMA = vol.Schema(
-    {DOMAIN: vol.Schema({vol.Required(CONF_DEVICE): cv.string})}, extra=vol.ALLOW_EXTRA
+    {DOMAIN: vol.Schema({
+        vol.Required(CONF_DEVICE): cv.string,
+        vol.Optional(CONF_SUMMARY_INTERVAL, default=0): cv.positive_int,
+        vol.Optional(CONF_CAPTURE): cv.string,
+        vol.Optional(CONF_THROTTLE, default={}): {cv.string: THROTTLE_SCHEMA},
+        vol.Optional(CONF_QUEUE_SIZE, default=ems.QUEUE_SIZE): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_OVERFLOW, default=ems.OVERFLOW_POLICIES[0]): vol.In(ems.OVERFLOW_POLICIES),
+        vol.Optional(CONF_RESTORE, default=True): cv.boolean,
+        # The HTTP server of the driver only runs if a port is given.
+        vol.Optional(CONF_HOST, default=ems.HTTP_HOST): cv.string,
+        vol.Optional(CONF_PORT): cv.port,
+    })}, extra=vol.ALLOW_EXTRA
 )
 
-def setup(hass, config):
+async def async_setup(hass, config):
     """Set up the EMS parser component"""
     conf = config[DOMAIN]
-    buderus_ems = BuderusEms(hass, conf[CONF_DEVICE])
+    ems.summary_interval = conf[CONF_SUMMARY_INTERVAL]
+    buderus_ems = BuderusEms(hass, conf[CONF_DEVICE], conf[CONF_QUEUE_SIZE], conf[CONF_OVERFLOW])
+    buderus_ems.throttle = conf[CONF_THROTTLE]
+    buderus_ems.capture_path = conf.get(CONF_CAPTURE)
+    if CONF_PORT in conf:
+        buderus_ems.http_address = (conf[CONF_HOST], conf[CONF_PORT])
+    if conf[CONF_RESTORE]:
+        await buderus_ems.async_restore()
 
-    def _start_ems(_event):
-        buderus_ems.start()
+    async def _start_ems(_event):
+        await buderus_ems.async_start()
 
+    @callback
     def _stop_ems(_event):
-        buderus_ems.stopped.set()
+        buderus_ems.stop()
 
-    hass.bus.listen_once(EVENT_HOMEASSISTANT_START, _start_ems)
-    #hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, _stop_ems)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, _start_ems)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _stop_ems)
 
-    #hass.data[DOMAIN] = buderus_ems
+    hass.data[DOMAIN] = buderus_ems
 
     for platform in PLATFORMS:
-        discovery.load_platform(hass, platform, DOMAIN, {}, config)
+        hass.async_create_task(discovery.async_load_platform(hass, platform, DOMAIN, {}, config))
         _LOGGER.debug('{}: platform {} loaded'.format(DOMAIN, platform))
 
     return(True)
 
-class BuderusEms(threading.Thread):
-    """Handles communication with the EMS bus"""
-    def __init__(self, hass, device):
-        super().__init__()
+class BuderusEms:
+    """Handles communication with the EMS bus
+
+    A thread reads and frames the serial port and queues the telegrammes. The queue is
+    drained in the event loop, where decoding and firing the events happen. So the
+    reading keeps up with the bus while Home Assistant is busy, and the queue policy
+    decides what is dropped if the loop falls behind.
+    """
+    def __init__(self, hass, device, queue_size=ems.QUEUE_SIZE, overflow=ems.OVERFLOW_POLICIES[0]):
         self._available = False
         self._device = device
+        self._port = None
+        self._queue = ems.TelegramQueue(queue_size, overflow)
+        self._reader = None
+        self.dispatcher = ems.Dispatcher()
+        self.throttle = {}
+        self.capture_path = None
+        self._capture = None
+        self.http_address = None
+        self._httpd = None
+        self._store = None
+        self._save_pending = False
+        # Sections with entities, and the functions of the platforms that add them
+        self.sections = set()
+        self._platforms = {}
         self.hass = hass
-        self.status = ems.status
+        self.state = ems.state
         _LOGGER.debug('{}: Initialized'.format(DOMAIN))
 
     @property
@@ -52,14 +117,115 @@ class BuderusEms(threading.Thread):
         """Return the availability of the connection"""
         return self._available
 
-    def run(self):
+    async def async_restore(self):
+        """Restore the saved state as stale values and save the state from now on"""
+        self._store = Store(self.hass, STORAGE_VERSION, STORAGE_KEY)
+        try:
+            data = await self._store.async_load()
+        except Exception as e:
+            _LOGGER.warning('{}: Cannot restore the state: {}'.format(DOMAIN, e))
+            return()
+        if data:
+            restored = ems.state.restore(data)
+            _LOGGER.debug('{}: Restored {}'.format(DOMAIN, ', '.join(restored)))
+            self.add_sections(set(restored) | ems.present_sections())
+
+    @callback
+    def register_platform(self, platform, add_sections):
+        """Register add_sections(sections) of a platform, which adds the entities of sections.
+
+        It is called at once for the sections known so far.
+        """
+        self._platforms[platform] = add_sections
+        if self.sections:
+            add_sections(set(self.sections))
+
+    @callback
+    def add_sections(self, sections):
+        """Add the entities of sections which do not have them yet"""
+        new = sections - self.sections
+        if not new:
+            return()
+        _LOGGER.debug('{}: Adding the entities of {}'.format(DOMAIN, ', '.join(sorted(new))))
+        self.sections |= new
+        for add_sections in self._platforms.values():
+            add_sections(new)
+
+    async def async_start(self):
+        """Open the serial port and start reading from it"""
         _LOGGER.debug('{}: Starting...'.format(DOMAIN))
         try:
-            port = ems.open_serial(self._device)
+            port = await self.hass.async_add_executor_job(ems.open_serial, self._device)
         except Exception as e:
             _LOGGER.error('{}: Could not open device {}: {}'.format(DOMAIN, self._device, e))
             return()
+        self._port = port
+        if self.capture_path:
+            try:
+                self._capture = await self.hass.async_add_executor_job(capture.CaptureWriter, self.capture_path)
+            except (OSError, ValueError) as e:
+                _LOGGER.error('{}: Cannot record to {}: {}'.format(DOMAIN, self.capture_path, e))
+
+        if self.http_address:
+            try:
+                self._httpd = await self.hass.async_add_executor_job(ems.start_http_server, *self.http_address)
+            except OSError as e:
+                _LOGGER.error('{}: Cannot start the HTTP server on {} port {}: {}'.format(
+                    DOMAIN, *self.http_address, e))
 
         _LOGGER.debug('{}: Port {} opened, reading...'.format(DOMAIN, port))
         self._available = True
-        ems.mainloop(port, self.hass)
+        self._reader = ems.Reader(port, self._queue, self._notify, self._capture)
+        self._reader.start()
+
+    @callback
+    def stop(self):
+        """Stop reading and close the serial port"""
+        if self._port is None:
+            return()
+        self._reader.stop()
+        self.hass.async_add_executor_job(self._close, self._reader, self._port, self._capture)
+        self._reader = None
+        self._port = None
+        self._capture = None
+        if self._httpd:
+            self.hass.async_add_executor_job(ems.stop_http_server, self._httpd)
+            self._httpd = None
+        self._available = False
+
+    @staticmethod
+    def _close(reader, port, capture):
+        reader.join()
+        os.close(port)
+        if capture:
+            capture.close()
+        _LOGGER.debug('{}: Port closed'.format(DOMAIN))
+
+    def _notify(self):
+        """Called from the reader thread when telegrammes are waiting"""
+        self.hass.loop.call_soon_threadsafe(self._drain)
+
+    @callback
+    def _drain(self):
+        for telegram in self._queue.drain():
+            ems.parse_message(telegram, self._fire)
+
+    @callback
+    def _fire(self, section, changes):
+        # Entities are created for the sections seen on the bus and for the sections of the
+        # devices listed by UBADevices. New entities take their value from ems.state.
+        if section not in self.sections:
+            self.add_sections({section})
+        if section == 'uba_devices':
+            self.add_sections(ems.present_sections())
+        self.dispatcher.dispatch(section, changes)
+        self.hass.bus.async_fire(EVENT_UPDATED + '_' + section, changes)
+        if self._store and not self._save_pending:
+            # async_delay_save() starts over with every call, so only call it once per save.
+            self._save_pending = True
+            self._store.async_delay_save(self._state_to_save, STATE_SAVE_DELAY)
+
+    @callback
+    def _state_to_save(self):
+        self._save_pending = False
+        return(ems.state.dump())
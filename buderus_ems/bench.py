@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks of the EMS bus driver. Run it from the component folder:
+#   python3 bench.py [--count 20000] [--repeating]
+#
+# The telegrammes are synthetic, with correct CRCs, for every message definition. The
+# stream contains PARMRK escapes, BREAKs and master polls like the real bus. Each stage
+# of the pipeline is measured on its own, then the whole pipeline from the framer to
+# stub entities behind the dispatcher and a stub Home Assistant bus.
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+
+try:
+    from . import ems
+except ImportError:
+    import ems
+
+def crc_check_reference(telegram):
+    """The CRC check as it was before the table driven version, for comparison"""
+    crc = 0
+    for value in telegram[0:-1]:
+        crc = ems.crc_lookup_table[crc]
+        crc ^= value
+    return(crc == telegram[-1])
+
+def make_payload(msgdef, rnd):
+    """Random payload of a message, with valid text and times where the fields need them"""
+    payload = bytearray(rnd.getrandbits(8) for _ in range(msgdef['len']))
+    for f in msgdef['fields']:
+        offset = f['offset']
+        if f['type'] == 'str2':
+            payload[offset:offset + 2] = bytes(rnd.choice(b'-ABCDEFH0123456789') for _ in range(2))
+        elif f['type'] in ('datetime', 'datetime5'):
+            # Year, month, hour, day, minute, second
+            values = (rnd.randrange(100), rnd.randrange(1, 13), rnd.randrange(24), rnd.randrange(1, 29),
+                      rnd.randrange(60), rnd.randrange(60))
+            size = 6 if f['type'] == 'datetime' else 5
+            payload[offset:offset + size] = bytes(values[:size])
+    return(bytes(payload))
+
+def make_telegrams(count, repeating=False, seed=1):
+    """Return count response telegrammes of all message types, EMS+ ones included, to everyone.
+
+    Each message comes from the first address of its device kind, so it goes to its plain
+    section, or from the UBA if it has no kind.
+
+    With repeating, every message type always sends the same payload, like idle broadcasts.
+    """
+    rnd = random.Random(seed)
+    payloads = {}
+    telegrams = []
+    for index in range(count):
+        msgdef = ems.messagedefinitions[index % len(ems.messagedefinitions)]
+        if not repeating or msgdef['id'] not in payloads:
+            payloads[msgdef['id']] = make_payload(msgdef, rnd)
+        src = ems.DEVICE_ADDRESSES.get(msgdef.get('source'), [0x08])[0]
+        telegrams.append(ems.build_telegram(src, 0x00, msgdef['id'], payloads[msgdef['id']]))
+    return(telegrams)
+
+def make_stream(telegrams):
+    """The bytes read from the serial port for the telegrammes, each followed by a master poll"""
+    poll = ems.escape_telegram(b'\x88')
+    return(b''.join(ems.escape_telegram(telegram) + poll for telegram in telegrams))
+
+class StubEntity:
+    """Stands in for a sensor entity behind the dispatcher"""
+    def __init__(self):
+        self.state = None
+        self.writes = 0
+
+    def set_value(self, value):
+        if value == self.state:
+            return(False)
+        self.state = value
+        return(True)
+
+    def write_state(self):
+        self.writes += 1
+
+class StubBus:
+    """Stands in for the Home Assistant event bus"""
+    def __init__(self):
+        self.events = 0
+
+    def async_fire(self, event_type, data):
+        self.events += 1
+
+def make_dispatcher():
+    dispatcher = ems.Dispatcher()
+    entities = []
+    for platform in ('sensor', 'binary_sensor'):
+        for definition in ems.entity_definitions(platform):
+            entity = StubEntity()
+            dispatcher.register(definition[0], definition[1], entity)
+            entities.append(entity)
+    return(dispatcher, entities)
+
+def reset_driver():
+    ems.last_telegrams.clear()
+    ems.statistics.reset()
+    ems.state.clear()
+
+def measure(function, repeat=3, setup=None):
+    """Return the best time of function() in seconds. setup() is called untimed before each run."""
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best)
+
+def measure_memory(function, setup=None):
+    """Return the peak of traced memory in bytes and the number of memory blocks left over by function()"""
+    if setup:
+        setup()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return(peak, sys.getallocatedblocks() - blocks)
+
+def rate(function, count, repeat=3):
+    """Call function(), which processes count telegrammes, and return the best telegrammes per second"""
+    return(count / measure(function, repeat))
+
+def bench_crc(count=20000):
+    telegrams = make_telegrams(count)
+    results = {
+        'reference': rate(lambda: [crc_check_reference(t) for t in telegrams], count),
+        'crc_check': rate(lambda: [ems.crc_check(t) for t in telegrams], count),
+        'crc_check_many': rate(lambda: ems.crc_check_many(telegrams), count),
+    }
+    print('CRC check of {} telegrammes:'.format(count))
+    for name, value in results.items():
+        print('    {:<15}: {:10.0f} telegrammes/s ({:.1f}x)'.format(name, value, value / results['reference']))
+
+def bench_pipeline(count=20000, repeating=False):
+    telegrams = make_telegrams(count, repeating)
+    stream = make_stream(telegrams)
+    chunks = [stream[pos:pos + ems.READ_SIZE] for pos in range(0, len(stream), ems.READ_SIZE)]
+    decoded = [(ems.messagedefinitions[index % len(ems.messagedefinitions)], t) for index, t in enumerate(telegrams)]
+    sections = [(msgdef['short'], msgdef['decode'](t, msgdef['header'])) for msgdef, t in decoded
+                if msgdef['decode'] and msgdef.get('short')]
+
+    def framing():
+        framer = ems.Framer(lambda telegram, parity_errors: None)
+        for chunk in chunks:
+            framer.feed(chunk)
+
+    def crc():
+        for telegram in telegrams:
+            ems.crc_check(telegram)
+
+    def decode():
+        for msgdef, telegram in decoded:
+            if msgdef['decode']:
+                msgdef['decode'](telegram, msgdef['header'])
+
+    # Set up untimed before each run of dispatch() and pipeline()
+    stubs = {}
+
+    def setup():
+        reset_driver()
+        stubs['dispatcher'] = make_dispatcher()[0]
+        stubs['bus'] = StubBus()
+
+    def dispatch():
+        dispatcher = stubs['dispatcher']
+        for section, values in sections:
+            dispatcher.dispatch(section, values)
+
+    def pipeline():
+        dispatcher = stubs['dispatcher']
+        bus = stubs['bus']
+
+        def fire(section, changes):
+            dispatcher.dispatch(section, changes)
+            bus.async_fire('buderus_ems_received_' + section, changes)
+
+        framer = ems.Framer(lambda telegram, parity_errors: ems.parse_message(telegram, fire))
+        for chunk in chunks:
+            framer.feed(chunk)
+
+    print('Pipeline with {} {} telegrammes, {} bytes on the bus:'.format(
+        count, 'repeating' if repeating else 'changing', len(stream)))
+    print('    {:<9} {:>14} {:>14} {:>16} {:>16}'.format(
+        'stage', 'telegrammes/s', 'µs/telegramme', 'peak KiB', 'blocks left'))
+    for name, function, stage_setup in (('framing', framing, None), ('crc', crc, None), ('decode', decode, None),
+                                        ('dispatch', dispatch, setup), ('pipeline', pipeline, setup)):
+        elapsed = measure(function, setup=stage_setup)
+        peak, blocks = measure_memory(function, stage_setup)
+        print('    {:<9} {:>14.0f} {:>14.2f} {:>16.1f} {:>16d}'.format(
+            name, count / elapsed, elapsed / count * 1e6, peak / 1024, blocks))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the EMS bus driver')
+    parser.add_argument('--count', type=int, default=20000, help='Number of telegrammes')
+    parser.add_argument('--repeating', action='store_true',
+                        help='Repeat the same payload per message type, like idle broadcasts')
+    args = parser.parse_args()
+    bench_crc(args.count)
+    bench_pipeline(args.count, args.repeating)
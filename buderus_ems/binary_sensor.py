@@ -1,92 +1,48 @@
 """Platform for sensor integration."""
-from homeassistant.const import DEVICE_CLASS_POWER, DEVICE_CLASS_TEMPERATURE, \
-                                DEVICE_CLASS_PRESSURE, DEVICE_CLASS_TIMESTAMP, PRESSURE_BAR, \
-                                TEMP_CELSIUS
-from homeassistant.helpers.entity import Entity
-from homeassistant.components.binary_sensor import BinarySensorDevice, DEVICE_CLASS_OPENING
-from . import DOMAIN, EVENT_UPDATED
+from homeassistant.core import callback
+from homeassistant.components.binary_sensor import BinarySensorDevice
+from . import ems, DOMAIN
 import logging
 
 _LOGGER = logging.getLogger(__name__)
 
-# section, name, description, 
-ems_sensors = [
-    # UBAMonitorFast
-    ['uba_fast', 'gasValve1', 'Gas valve stage 1', DEVICE_CLASS_OPENING],
-    ['uba_fast', 'gasValve2', 'Gas valve stage 2', DEVICE_CLASS_OPENING],
-    ['uba_fast', 'fan', 'Ventilation', None],
-    ['uba_fast', 'ignition', 'Ignition', None],
-    ['uba_fast', 'boilerPump', 'Boiler pump', None],
-    ['uba_fast', 'valveDrinkWater', 'Valve set to drinkwater heating', None],
-    ['uba_fast', 'drinkWaterCircPump', 'Drink water circulation pump', None],
-
-    # UBAMonitorWWMessage values
-    ['uba_dw', 'dayMode', 'Day Mode', None],
-    ['uba_dw', 'singleHeat', 'One shot drinkwater heat', None],
-    ['uba_dw', 'thermDesinfect', 'Thermal desinfection', None],
-    ['uba_dw', 'heatingEnabled', 'Drinkwater heating', None],
-    ['uba_dw', 'reHeat', 'Drinkwater reheating', None],
-    ['uba_dw', 'setTempReached', 'Drinkwater temperature okay', None],
-    ['uba_dw', 'sensor1Error', 'Drinkwater sensor 1 error', None],
-    ['uba_dw', 'sensor2Error', 'Drinkwater sensor 2 error', None],
-    ['uba_dw', 'generalError', 'Drinkwater heating error', None],
-    ['uba_dw', 'desinfectError', 'Drinkwater desinfection error', None],
-    ['uba_dw', 'circDayMode', 'Drinkwater day mode circulation', None],
-    ['uba_dw', 'circManual', 'Drinkwater manual circulation', None],
-    ['uba_dw', 'circOn', 'Drinkwater enabled', None],
-    ['uba_dw', 'heatingNow', 'Drinkwater currently heating', None],
-
-    # HK1MonitorMessage
-    ['hk1', 'onOptimize', 'Optimize turn on', None],
-    ['hk1', 'offOptimize', 'Optimize turn off', None],
-    ['hk1', 'automatic', 'Automatic mode', None],
-    ['hk1', 'preferDrinkwater', 'Prefer drink water heating', None],
-    ['hk1', 'screedDrying', 'Screed drying', None],
-    ['hk1', 'vacationMode', 'Vacation mode', None],
-    ['hk1', 'frostProtection', 'Frost protection mode', None],
-    ['hk1', 'manual', 'Manual mode', None],
-    ['hk1', 'summerMode', 'Summer mode', None],
-    ['hk1', 'dayMode', 'Day mode', None],
-    ['hk1', 'remoteDisconnected', 'Remote disconnected', None],
-    ['hk1', 'remoteError', 'Remote Error', None],
-    ['hk1', 'forwardFlowSensorError', 'Forward flow sensor error', None],
-    ['hk1', 'maxForwardFlow', 'Maximum forward flow', None],
-    ['hk1', 'externalError', 'External error', None],
-    ['hk1', 'partyPauseMode', 'Party pause mode', None],
-    #['hk1', 'state0', '', None],
-    #['hk1', 'state1', '', None],
-    #['hk1', 'stateParty', '', None],
-    #['hk1', 'statePause', '', None],
-    #['hk1', 'state4', '', None],
-    #['hk1', 'state5', '', None],
-    #['hk1', 'stateVacation', '', None],
-    #['hk1', 'stateHoliday', '', None],
-
-    # RCTimeMessage
-    #['rc_time', 'dayOfWeek', 'Day of week', None],
-    #['rc_time', 'summerTime', 'Summer time', None],
-    #['rc_time', 'radioClock', 'Radio clock source', None],
-    #['rc_time', 'timeBad', 'Incorrect time', None],
-    #['rc_time', 'dateBad', 'incorrect date', None],
-    #['rc_time', 'clockRunning', 'Clock enabled', None],
-]
-
-def setup_platform(hass, config, add_entities, discovery_info=None):
-    sensors = [EmsBinarySensor(hass, sens_def) for sens_def in ems_sensors]
-    add_entities(sensors, True)
-    _LOGGER.debug('{}: Binary sensors added'.format(DOMAIN))
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    @callback
+    def add_sections(sections):
+        # section, name, description, device class
+        sensors = [EmsBinarySensor(sens_def) for section in sections
+                   for sens_def in ems.section_entities('binary_sensor', section)]
+        if sensors:
+            async_add_entities(sensors)
+            _LOGGER.debug('{}: {} binary sensors added'.format(DOMAIN, len(sensors)))
+
+    hass.data[DOMAIN].register_platform('binary_sensor', add_sections)
 
 class EmsBinarySensor(BinarySensorDevice):
     """Representation of a Sensor."""
 
-    def __init__(self, hass, definition):
+    def __init__(self, definition):
         """Initialize the sensor."""
         self._state = None
         self._available = False
         self._variable = definition[1]
         self._name = definition[2]
         self._class = definition[3]
-        hass.bus.listen(EVENT_UPDATED + '_' + definition[0], self._handle_update)
+        self._section = definition[0]
+        self._stale = False
+
+    async def async_added_to_hass(self):
+        """Register with the dispatcher for updates of the value and take the current value."""
+        self.hass.data[DOMAIN].dispatcher.register(self._section, self._variable, self)
+        record = ems.state[self._section]
+        value = record.get(self._variable)
+        if value is not None:
+            self.set_value(value)
+            self._stale = record.stale
+
+    async def async_will_remove_from_hass(self):
+        """Unregister from the dispatcher."""
+        self.hass.data[DOMAIN].dispatcher.unregister(self._section, self._variable)
 
     @property
     def name(self):
@@ -118,12 +74,25 @@ class EmsBinarySensor(BinarySensorDevice):
         """Return the state of the sensor."""
         return(self._state)
 
-    def _handle_update(self, call):
-        try:
-            value = call.data[self._variable]
-            self._state = value
-            self._available = True
-            self.schedule_update_ha_state()
-        except KeyError as e:
-            _LOGGER.error('No value for {} in update data'.format(e))
+    @property
+    def device_state_attributes(self):
+        """Mark restored values until the value is received again."""
+        if self._stale:
+            return({'stale': True})
+        return(None)
+
+    def set_value(self, value):
+        """Take a new value from the dispatcher. Returns True if the state changed."""
+        if self._stale:
+            # Publish the first received value, even if it equals the restored one.
+            self._stale = False
             self._available = False
+        if self._available and value == self._state:
+            return(False)
+        self._state = value
+        self._available = True
+        return(True)
+
+    @callback
+    def write_state(self):
+        self.async_write_ha_state()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Recording and replay of raw EMS telegrammes.
+#
+# A capture file starts with MAGIC, followed by one record per telegramme:
+# timestamp (float64, seconds since the epoch), flags (uint8), length (uint8), all little
+# endian, and the telegramme itself without BREAK. Records are only ever appended.
+#
+# Usage from the component folder:
+#   python3 capture.py record /dev/ttyAMA0 bus.emscap
+#   python3 capture.py replay bus.emscap [--realtime] [--speed 10] [--print]
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+
+try:
+    from . import ems
+except ImportError:
+    import ems
+
+MAGIC = b'EMSCAP1\n'
+FLAG_PARITY_ERRORS = 0x01
+# Write buffer of the recorder. Telegrammes are at most a few dozen bytes, so this holds
+# several minutes of bus traffic.
+CAPTURE_BUFFER = 64 * 1024
+
+record_header = struct.Struct('<dBB')
+
+_LOGGER = logging.getLogger(__name__)
+
+class CaptureWriter:
+    """Appends telegrammes to a capture file through a write buffer"""
+    def __init__(self, path, buffering=CAPTURE_BUFFER):
+        self.file = open(path, 'ab', buffering=buffering)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        else:
+            with open(path, 'rb') as existing:
+                if existing.read(len(MAGIC)) != MAGIC:
+                    self.file.close()
+                    raise ValueError('{} is not a capture file'.format(path))
+
+    def write(self, telegram, parity_errors=False, timestamp=None):
+        flags = FLAG_PARITY_ERRORS if parity_errors else 0
+        self.file.write(record_header.pack(time.time() if timestamp is None else timestamp, flags, len(telegram)))
+        self.file.write(telegram)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def iter_capture(path):
+    """Yield (timestamp, flags, telegram) for each record of a capture file.
+
+    The file is memory mapped and telegram is a memoryview into it, which is only valid
+    until the next record is requested. A truncated last record is ignored.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        mapped.close()
+        raise ValueError('{} is not a capture file'.format(path))
+    view = memoryview(mapped)
+    pos = len(MAGIC)
+    end = size - record_header.size
+    while pos <= end:
+        timestamp, flags, length = record_header.unpack_from(mapped, pos)
+        pos += record_header.size
+        if pos + length > size:
+            break
+        yield timestamp, flags, view[pos:pos + length]
+        pos += length
+
+def replay(path, callback=None, realtime=False, speed=1.0):
+    """Feed the telegrammes of a capture through the framer and decoder.
+
+    Without realtime, the capture is replayed as fast as possible. Otherwise the
+    original timing is kept, sped up by speed. Telegrammes recorded with parity errors
+    are fed with a parity mark again. Returns the number of telegrammes.
+    """
+    framer = ems.Framer(lambda telegram, parity_errors: ems.parse_message(telegram, callback))
+    count = 0
+    start = None
+    for timestamp, flags, telegram in iter_capture(path):
+        if realtime:
+            if start is None:
+                start = (timestamp, time.monotonic())
+            delay = (timestamp - start[0]) / speed - (time.monotonic() - start[1])
+            if delay > 0:
+                time.sleep(delay)
+        framer.feed(ems.escape_telegram(telegram, flags & FLAG_PARITY_ERRORS))
+        count += 1
+    return(count)
+
+def record(device, path):
+    """Record and decode the telegrammes of a serial port until interrupted"""
+    capture = CaptureWriter(path)
+    try:
+        ems.mainloop(ems.open_serial(device), capture=capture)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record or replay raw EMS telegrammes')
+    commands = parser.add_subparsers(dest='command')
+    recorder = commands.add_parser('record', help='Record telegrammes from a serial port')
+    recorder.add_argument('device')
+    recorder.add_argument('file')
+    player = commands.add_parser('replay', help='Decode the telegrammes of a capture')
+    player.add_argument('file')
+    player.add_argument('--realtime', action='store_true', help='Keep the original timing')
+    player.add_argument('--speed', type=float, default=1.0, help='Speed up the realtime replay')
+    player.add_argument('--print', action='store_true', help='Print the decoded values')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        record(args.device, args.file)
+    elif args.command == 'replay':
+        logging.basicConfig(level=logging.DEBUG if args.print else logging.INFO, format='%(message)s')
+        ems.printing = args.print
+        start = time.perf_counter()
+        count = replay(args.file, realtime=args.realtime, speed=args.speed)
+        elapsed = time.perf_counter() - start
+        print('Replayed {} telegrammes in {:.3f} s ({:.0f} telegrammes/s)'.format(
+            count, elapsed, count / elapsed if elapsed else 0))
+    else:
+        parser.print_help()
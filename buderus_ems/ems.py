@@ -9,17 +9,53 @@
 
 import time
 import struct
+import bisect
+import re
 import termios
 import os
 import json
+import gzip
+from email.utils import formatdate, parsedate_to_datetime
 from datetime import datetime
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import socketserver
 import threading
+import queue
+import select
+from collections import OrderedDict, deque
+import logging
 
 SERIAL_PORT = '/dev/ttyAMA0'
+HTTP_HOST = 'localhost'
 HTTP_PORT = 8014
+# Idle keep-alive connections of the HTTP server are closed after HTTP_TIMEOUT seconds.
+HTTP_TIMEOUT = 60
+# Events buffered per client of /events. A client that falls further behind is dropped.
+EVENT_QUEUE_SIZE = 100
+# An idle event stream gets a comment every EVENT_KEEPALIVE seconds.
+EVENT_KEEPALIVE = 15
 printing = False
+# Log a summary of the received message types every summary_interval seconds. 0 disables it.
+summary_interval = 0
+
+_LOGGER = logging.getLogger(__name__)
+
+# Serial read batching. read() returns as soon as SERIAL_VMIN bytes are buffered or the line
+# was idle for SERIAL_VTIME tenths of a second after the first byte. Each read fetches up
+# to READ_SIZE bytes, so a whole telegramme usually costs a single syscall.
+SERIAL_VMIN = 64
+SERIAL_VTIME = 1
+READ_SIZE = 256
+# Longest telegramme the framer accepts. EMS telegrammes are at most 32 bytes long.
+MAX_TELEGRAM = 64
+# Telegrammes waiting between the reader thread and the decoder, and what to do when the
+# queue is full. 'coalesce' keeps only the latest telegramme per header and drops the
+# oldest waiting one when full, 'drop_oldest' and 'drop_newest' keep every telegramme in
+# order until the queue is full.
+QUEUE_SIZE = 64
+OVERFLOW_POLICIES = ('coalesce', 'drop_oldest', 'drop_newest')
+# The reader thread checks for a stop request every READER_POLL seconds.
+READER_POLL = 0.5
 
 ###############################################################
 # CRC Check fuer EMS Telegramme
@@ -47,14 +83,54 @@ crc_lookup_table = [0x00, 0x02, 0x04, 0x06, 0x08, 0x0A, 0x0C, 0x0E, 0x10, 0x12,
                     0xB9, 0xBB, 0xBD, 0xBF, 0xB1, 0xB3, 0xB5, 0xB7, 0xA9, 0xAB, 0xAD, 0xAF, 0xA1, 0xA3, 0xA5, 0xA7,
                     0xD9, 0xDB, 0xDD, 0xDF, 0xD1, 0xD3, 0xD5, 0xD7, 0xC9, 0xCB, 0xCD, 0xCF, 0xC1, 0xC3, 0xC5, 0xC7,
                     0xF9, 0xFB, 0xFD, 0xFF, 0xF1, 0xF3, 0xF5, 0xF7, 0xE9, 0xEB, 0xED, 0xEF, 0xE1, 0xE3, 0xE5, 0xE7]
-def crc_check(telegram):
+def crc_calculate(data, table=tuple(crc_lookup_table)):
+    """Return the CRC of data, for building telegrammes"""
+    crc = 0
+    for value in data:
+        crc = table[crc] ^ value
+    return(crc)
+
+def crc_check(telegram, table=tuple(crc_lookup_table)):
     crc = 0
-    for value in telegram[0:-1]:
-        crc = crc_lookup_table[crc]
-        crc ^= value
+    for value in telegram[:-1]:
+        crc = table[crc] ^ value
     return(crc == telegram[-1])
 
-def open_serial(path):
+crc_translation = bytes(crc_lookup_table)
+
+def crc_check_many(telegrams):
+    """Check the CRCs of many telegrammes at once. Returns a list of booleans.
+
+    Telegrammes of the same length are checked together, one byte position at a time:
+    bytes.translate() looks up the CRC table for that column of all telegrammes in one
+    call, and the XOR with the column is done on one big integer.
+    """
+    results = [False] * len(telegrams)
+    groups = {}
+    for index, telegram in enumerate(telegrams):
+        groups.setdefault(len(telegram), []).append(index)
+    for length, indices in groups.items():
+        if length == 0:
+            continue
+        count = len(indices)
+        joined = b''.join(telegrams[index] for index in indices)
+        crc = bytes(count)
+        for pos in range(length - 1):
+            crc = (int.from_bytes(crc.translate(crc_translation), 'big') ^
+                   int.from_bytes(joined[pos::length], 'big')).to_bytes(count, 'big')
+        expected = joined[length - 1::length]
+        if crc == expected:
+            for index in indices:
+                results[index] = True
+        else:
+            for index, calculated, received in zip(indices, crc, expected):
+                results[index] = calculated == received
+    return(results)
+
+def is_pseudo_terminal(path):
+    return(os.path.realpath(path).startswith('/dev/pts/'))
+
+def open_serial(path, vmin=SERIAL_VMIN, vtime=SERIAL_VTIME):
     ser = os.open(path, os.O_RDWR | os.O_NOCTTY)
     iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(ser)
 
@@ -73,7 +149,12 @@ def open_serial(path):
         iflag &= ~termios.IUCLC
     # Enable parity marking. This is important as each telegramme is terminated by a BREAK signal.
     # Without it, we could not distinguish between two telegrammes.
-    iflag |= termios.PARMRK
+    # A pseudo terminal cannot carry a BREAK, so the other side (the simulator) sends the
+    # marked stream itself. With PARMRK, the kernel would escape its 0xff characters again.
+    if is_pseudo_terminal(path):
+        iflag &= ~termios.PARMRK
+    else:
+        iflag |= termios.PARMRK
 
     # 9600 baud
     ispeed = ospeed = termios.B9600
@@ -89,351 +170,830 @@ def open_serial(path):
     iflag &= ~(termios.IXON | termios.IXOFF)
     cflag &= ~(termios.CRTSCTS)
     # Buffer
-    cc[termios.VMIN] = 1
-    cc[termios.VTIME] = 0
+    cc[termios.VMIN] = vmin
+    cc[termios.VTIME] = vtime
 
     termios.tcsetattr(ser, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
     return(ser)
 
 # https://domoticproject.com/wp-content/uploads/2018/03/EMSWiki-telegramme-DEU.pdf
 
-status = {
-    'uba_fast': {},
-    'uba_slow': {},
-    'uba_dw': {},
-    'hk1': {},
-    'rc_time': {},
-    'uba_setvalues': {},
-    'uba_runtime': {},
-    'rc_outdoortemp': {},
+# Units and device classes of the values. They are the same strings Home Assistant uses.
+TEMP_CELSIUS = '°C'
+PRESSURE_BAR = 'bar'
+PERCENT = '%'
+CURRENT_MILLIAMPS = 'mA'
+LITERS_PER_MINUTE = 'l/min'
+DURATION_MINUTES = 'min'
+DEVICE_CLASS_TEMPERATURE = 'temperature'
+DEVICE_CLASS_PRESSURE = 'pressure'
+DEVICE_CLASS_POWER = 'power'
+DEVICE_CLASS_OPENING = 'opening'
+
+# Field types: struct format of the raw value
+FIELD_TYPES = {
+    'u8': 'B',
+    's8': 'b',
+    'u16': 'H',
+    's16': 'h',
+    'u24': 'BH',
+    'bool': 'B',
+    'str2': '2s',
+    # Year (since 2000), month, hour, day, minute, second
+    'datetime': 'BBBBBB',
+    # Like datetime without seconds. Bit 7 of the year is a flag.
+    'datetime5': 'BBBBB',
 }
 
-# https://domoticproject.com/ems-bus-buderus-nefit-boiler/#0x18_8211UBA_Monitor_Fast
-# https://emswiki.thefischer.net/doku.php?id=wiki:ems:telegramme#ubamonitorfast
-def printUBAMonitorFast(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'flowTempSet': values[0],
-        'flowTempIs': values[1] / 10,
-        'burnPowSet': values[2],
-        'burnPowIs': values[3],
-        'gasValve1': bool(values[4] & 0x01),
-        'gasValve2': bool(values[4] & 0x02),
-        'fan': bool(values[4] & 0x04),
-        'ignition': bool(values[4] & 0x08),
-        'boilerPump': bool(values[4] & 0x20),
-        'valveDrinkWater': bool(values[4] & 0x40),
-        'drinkWaterCircPump': bool(values[4] & 0x80),
-        'boilerTemp': None if values[5] == -32768 else values[5] / 10,
-        'drinkWaterTemp': values[6] / 10,
-        'flowReturnTemp': values[7] / 10,
-        'flameCurrent': values[8] / 10,
-        'systemPressure': values[9] / 10,
-        'serviceCode': values[10].decode('ASCII'),
-        'errorCode': values[11],
-        'intakeTemp': values[12] / 10,
-    }
-    if printing:
-        print('Vorlauf Solltemperatur         : {} °C'.format(parsed['flowTempSet'])) # Selected Flow Temperature
-        print('Vorlauf Isttemperatur          : {} °C'.format(parsed['flowTempIs'])) # Current Flow Temperature
-        print('Kessel maximale Leistung       : {} %'.format(parsed['burnPowSet'])) # Selected Burning Power
-        print('Kessel aktuelle Leistung       : {} %'.format(parsed['burnPowIs'])) # Current Burning Power
-        print('Magnetventil für 1. Stufe      : {}'.format('An' if parsed['gasValve1'] else 'Aus'))
-        print('Magnetventil für 2. Stufe      : {}'.format('An' if parsed['gasValve2'] else 'Aus'))
-        print('Gebläse                        : {}'.format('An' if parsed['fan'] else 'Aus'))
-        print('Zündung                        : {}'.format('An' if parsed['ignition'] else 'Aus'))
-        print('Kesselkreispumpe               : {}'.format('An' if parsed['boilerPump'] else 'Aus'))
-        print('3-Wege-Ventil auf Warmwasser   : {}'.format('An' if parsed['valveDrinkWater'] else 'Aus'))
-        print('Zirkulation                    : {}'.format('An' if parsed['drinkWaterCircPump'] else 'Aus'))
-        print('Temperatur (DL-Erhitzer?)      : {} °C'.format(parsed['boilerTemp']))
-        print('Wassertemperatur               : {} °C'.format(parsed['drinkWaterTemp']))
-        print('Temperatur Rücklauf            : {} °C'.format(parsed['flowReturnTemp'])) #Current Flow Return Temperature
-        print('Flammenstrom                   : {} µA'.format(parsed['flameCurrent'])) # Flame current
-        print('Systemdruck                    : {} bar'.format(parsed['systemPressure'])) # System Pressure
-        print('Service code                   : {}'.format(parsed['serviceCode']))
-        print('Error code                     : {}'.format(parsed['errorCode']))
-        print('Ansauglufttemperatur           : {}'.format(parsed['intakeTemp']))
-    return(parsed)
-
-def printUBAMonitorSlow(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'outsideTemp': values[0] / 10,
-        'boilerTemp': None if values[1] == 0x8000 else values[1] / 10,
-        'exhaustTemp': None if values[2] == -32768 else values[2] / 10,
-        'pumpMod': values[3],
-        'burnStarts': values[4] << 16 | values[5],
-        'burnOperTot': values[6] << 16 | values[7],
-        'burnOperStage2': values[8] << 16 | values[9],
-        'burnOperHeat': values[10] << 16 | values[11],
-        'burnOperDrinkWater': values[12] << 16 | values[13],
-    }
-    if printing:
-        print('Außentemperatur                : {} °C'.format(parsed['outsideTemp']))
-        print('Kessel-Ist-Temperatur          : {} °C'.format(parsed['boilerTemp']))
-        print('Abgastemperatur                : {} °C'.format(parsed['exhaustTemp']))
-        print('Pumpenmodulation               : {} %'.format(parsed['pumpMod']))
-        print('Brennerstarts                  : {}'.format(parsed['burnStarts']))
-        print('Betriebszeit komplett (Brenner): {} min'.format(parsed['burnOperTot']))
-        print('Betriebszeit Brenner Stufe 2   : {} min'.format(parsed['burnOperStage2']))
-        print('Betriebszeit heizen            : {} min'.format(parsed['burnOperHeat']))
-        print('Noch eine Zeit                 : {} min'.format(parsed['burnOperDrinkWater']))
-    return(parsed)
+def field(name, offset, type='u8', scale=None, mask=None, sentinel=None, unit=None, device_class=None,
+          entity=None, description=None, label=None, names=None, equals=None):
+    """Declare a value of a message.
+
+    offset is counted from the start of the payload. The raw value is masked with mask,
+    or tested against it for type 'bool'. A 'bool' with equals is only true if the raw
+    value is equals. Other values are None if they equal sentinel, else they are
+    multiplied by scale. entity ('sensor' or 'binary_sensor') makes the value an entity
+    named description. label is the German description used when printing, names maps
+    the value to text, for a 'bool' as (false, true).
+    """
+    return({
+        'name': name, 'offset': offset, 'type': type, 'scale': scale, 'mask': mask, 'sentinel': sentinel,
+        'unit': unit, 'device_class': device_class, 'entity': entity, 'description': description,
+        'label': label, 'names': names, 'equals': equals,
+    })
 
 warmwassersysteme = [
     'Kein Warmwasser', 'Nach Durchlaufprinzip', 'Durchlaufprinzip mit kleinem Speicher', 'Speicherprinzip'
 ]
-def printUBAMonitorWWMessage(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'tempSet': values[0],
-        'sensor1tempIs': values[1] / 10,
-        'sensor2TempIs': values[2] / 10,
-        'dayMode': bool(values[3] & 0x01),
-        'singleHeat': bool(values[3] & 0x02),
-        'thermDesinfect': bool(values[3] & 0x04),
-        'heatingEnabled': bool(values[3] & 0x08),
-        'reHeat': bool(values[3] & 0x10),
-        'setTempReached': bool(values[3] & 0x20),
-        'sensor1Error': bool(values[4] & 0x01),
-        'sensor2Error': bool(values[4] & 0x02),
-        'generalError': bool(values[4] & 0x04),
-        'desinfectError': bool(values[4] & 0x08),
-        'circDayMode': bool(values[5] & 0x01),
-        'circManual': bool(values[5] & 0x02),
-        'circOn': bool(values[5] & 0x04),
-        'heatingNow': bool(values[5] & 0x08),
-        'systemType': values[6],
-        'currentFlow': values[7] / 10,
-        'heatingTime': values[8] << 16 | values[9],
-        'heatingRuns': values[10] << 16 | values[11],
-    }
-    if printing:
-        print('Warmwasser Temperatur Soll         : {} °C'.format(parsed['tempSet']))
-        print('Warmwasser Temperatur Ist          : {} °C'.format(parsed['sensor1tempIs']))
-        print('Warmwasser Temperatur Ist 2. Fühler: {} °C'.format(parsed['sensor2TempIs']))
-        print('Tagbetrieb                         : {}'.format('Ja' if parsed['dayMode'] else 'Nein'))
-        print('Einmalladung                       : {}'.format('An' if parsed['singleHeat'] else 'Aus'))
-        print('Thermische Desinfektion            : {}'.format('An' if parsed['thermDesinfect'] else 'Aus'))
-        print('Warmwasserbereitung                : {}'.format('An' if parsed['heatingEnabled'] else 'Aus'))
-        print('Warmwassernachladung               : {}'.format('An' if parsed['reHeat'] else 'Aus'))
-        print('Warmwasser-Temperatur OK           : {}'.format('Ja' if parsed['setTempReached'] else 'Nein'))
-        print('Fühler 1 defekt                    : {}'.format('Ja' if parsed['sensor1Error'] else 'Nein'))
-        print('Fühler 2 defekt                    : {}'.format('Ja' if parsed['sensor2Error'] else 'Nein'))
-        print('Störung WW                         : {}'.format('Ja' if parsed['generalError'] else 'Nein'))
-        print('Störung Desinfektion               : {}'.format('Ja' if parsed['desinfectError'] else 'Nein'))
-        print('Zirkulation Tagbetrieb             : {}'.format('An' if parsed['circDayMode'] else 'Aus'))
-        print('Zirkulation Manuell gestartet      : {}'.format('An' if parsed['circManual'] else 'Aus'))
-        print('Zirkulation läuft                  : {}'.format('An' if parsed['circOn'] else 'Aus'))
-        print('Ladevorgang WW läuft               : {}'.format('An' if parsed['heatingNow'] else 'Aus'))
-
-        print('Art des Warmwassersystems          : {}'.format(warmwassersysteme[parsed['systemType']]))
-        print('Wwarmwasser Durchfluss             : {} l/min'.format(parsed['currentFlow']))
-        print('Warmwasserbereitungszeit           : {} min'.format(parsed['heatingTime']))
-        print('Warmwasserbereitungen              : {}'.format(parsed['heatingRuns']))
-    return(parsed)
-
-def printHK1MonitorMessage(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'onOptimize': bool(values[0] & 0x01),
-        'offOptimize': bool(values[0] & 0x02),
-        'automatic': bool(values[0] & 0x04),
-        'preferDrinkwater': bool(values[0] & 0x08),
-        'screedDrying': bool(values[0] & 0x10),
-        'vacationMode': bool(values[0] & 0x20),
-        'frostProtection': bool(values[0] & 0x40),
-        'manual': bool(values[0] & 0x80),
-        'summerMode': bool(values[1] & 0x01),
-        'dayMode': bool(values[1] & 0x02),
-        'remoteDisconnected': bool(values[1] & 0x04),
-        'remoteError': bool(values[1] & 0x08),
-        'forwardFlowSensorError': bool(values[1] & 0x10),
-        'maxForwardFlow': bool(values[1] & 0x20),
-        'externalError': bool(values[1] & 0x40),
-        'partyPauseMode': bool(values[1] & 0x80),
-        'roomTempSet': values[2] / 2,
-        'roomTempIs': None if values[3] == 32000 else values[3] / 10,
-        'onOptimizeTime': values[4],
-        'offOptimizeTime': values[5],
-        'heatingCurve10Deg': values[6],
-        'heatingCurve0Deg': values[7],
-        'heatingCurveMinus10Deg': values[8],
-        'roomTempAdaptionTime': values[9] / 100,
-        'requestedBoilerPower': values[10],
-        'state0': bool(values[11] & 0x01),
-        'state1': bool(values[11] & 0x02),
-        'stateParty': bool(values[11] & 0x04),
-        'statePause': bool(values[11] & 0x08),
-        'state4': bool(values[11] & 0x10),
-        'state5': bool(values[11] & 0x20),
-        'stateVacation': bool(values[11] & 0x40),
-        'stateHoliday': bool(values[11] & 0x80),
-        'calculatedForwardTemp': values[12],
-    }
-    if printing:
-        print('Ausschaltoptimierung             : {}'.format('An' if values[0] & 0x01 else 'Aus'))
-        print('Einschaltoptimierung             : {}'.format('An' if values[0] & 0x02 else 'Aus'))
-        print('Automatikbetrieb                 : {}'.format('An' if values[0] & 0x04 else 'Aus'))
-        print('WW-Vorrang                       : {}'.format('An' if values[0] & 0x08 else 'Aus'))
-        print('Estrichtrocknung                 : {}'.format('An' if values[0] & 0x10 else 'Aus'))
-        print('Urlaubsbetrieb                   : {}'.format('An' if values[0] & 0x20 else 'Aus'))
-        print('Frostschutz                      : {}'.format('An' if values[0] & 0x40 else 'Aus'))
-        print('Manuell                          : {}'.format('An' if values[0] & 0x80 else 'Aus'))
-
-        print('Sommerbetrieb                    : {}'.format('An' if values[1] & 0x01 else 'Aus'))
-        print('Tagbetrieb                       : {}'.format('An' if values[1] & 0x02 else 'Aus'))
-        print('Keine Kommunikation mit FB (?)   : {}'.format('An' if values[1] & 0x04 else 'Aus'))
-        print('FB fehlerhaft (?)                : {}'.format('An' if values[1] & 0x08 else 'Aus'))
-        print('Fehler Vorlauffühler (?)         : {}'.format('An' if values[1] & 0x10 else 'Aus'))
-        print('Maximaler Vorlauf                : {}'.format('An' if values[1] & 0x20 else 'Aus'))
-        print('Externer Störeingang (?)         : {}'.format('An' if values[1] & 0x40 else 'Aus'))
-        print('Party- Pausebetrieb              : {}'.format('An' if values[1] & 0x80 else 'Aus'))
-
-        print('Raumtemperatur Soll              : {} °C'.format(values[2] / 2))
-        print('Raumtemperatur Ist               : {} °C'.format('Abgeschaltet' if values[3] == 32000 else values[3] / 10))
-        print('Einschaltoptimierungszeit        : {}'.format(values[4]))
-        print('Ausschaltoptimierungszeit        : {}'.format(values[5]))
-        print('Heizkreis1 Heizkurve 10°C        : {}'.format(values[6]))
-        print('Heizkreis1 Heizkurve 0°C         : {}'.format(values[7]))
-        print('Heizkreis1 Heizkurve -10°C       : {}'.format(values[8]))
-        print('Raumtemperatur-Änderungsgeschwindigkeit         : {}'.format(values[9] / 100))
-        print('Von diesem Heizkreis angeforderte Kesselleistung: {}'.format(values[10]))
-
-        print('Schaltzustand ???                : {}'.format('An' if values[11] & 0x01 else 'Aus'))
-        print('Schaltzustand ???                : {}'.format('An' if values[11] & 0x02 else 'Aus'))
-        print('Schaltzustand Party              : {}'.format('An' if values[11] & 0x04 else 'Aus'))
-        print('Schaltzustand Pause              : {}'.format('An' if values[11] & 0x08 else 'Aus'))
-        print('Schaltzustand ???                : {}'.format('An' if values[11] & 0x10 else 'Aus'))
-        print('Schaltzustand ???                : {}'.format('An' if values[11] & 0x20 else 'Aus'))
-        print('Schaltzustand Urlaub             : {}'.format('An' if values[11] & 0x40 else 'Aus'))
-        print('Schaltzustand Ferien             : {}'.format('An' if values[11] & 0x80 else 'Aus'))
-
-        print('Berechnete Solltemperatur Vorlauf: {} °C'.format(values[12]))
-
-        #print('Keine Raumtemperatur             : {}'.format('An' if values[13] & 0x02 else 'Aus'))
-        #print('Keine Absenkung                  : {}'.format('An' if values[13] & 0x04 else 'Aus'))
-        #print('Heizbetrieb an BC10 abgeschaltet : {}'.format('An' if values[13] & 0x08 else 'Aus'))
-    return(parsed)
-
+janein = ('Nein', 'Ja')
 wochentage = ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag', 'Samstag', 'Sonntag']
-def printRCTimeMessage(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'time': datetime(values[0] + 2000, values[1], values[3], values[2], values[4], values[5]).isoformat(),
-        'dayOfWeek': bool(values[0] & 0x01),
-        'summerTime': bool(values[0] & 0x02),
-        'radioClock': bool(values[0] & 0x04),
-        'timeBad': bool(values[0] & 0x08),
-        'dateBad': bool(values[0] & 0x10),
-        'clockRunning': bool(values[0] & 0x20),
-    }
-    if printing:
-        print('Zeit              : {:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(values[0] + 2000, values[1], values[3], values[2], values[4], values[5]))
-        print('Wochentag         : {}'.format(wochentage[values[6]]))
-        print('Sommerzeit        : {}'.format('Ja' if values[7] & 0x01 else 'Nein'))
-        print('Funkuhr           : {}'.format('Ja' if values[7] & 0x02 else 'Nein'))
-        print('Uhrzeit fehlerhaft: {}'.format('Ja' if values[7] & 0x04 else 'Nein'))
-        print('Datum fehlerhaft  : {}'.format('Ja' if values[7] & 0x08 else 'Nein'))
-        print('Uhr läuft         : {}'.format('Ja' if values[7] & 0x10 else 'Nein'))
-    return(parsed)
-
-def printUBASollwerte(values):
-    parsed = {
-        'boilerTempSet': values[0],
-        'requestedPowerHeating': values[1],
-        'requestedPowerDrinkwater': values[2],
-        'alwaysZero': values[3],
-    }
-    if printing:
-        print('Kessel-Solltemperatur  : {} °C'.format(parsed['boilerTempSet']))
-        print('Leistungsanforderung HK: {}'.format(parsed['requestedPowerHeating']))
-        print('Leistungsanforderung WW: {}'.format(parsed['requestedPowerDrinkwater']))
-        print('Immer 0                : {}'.format(parsed['alwaysZero']))
-    return(parsed)
-
-def printFlags(values):
-    if printing:
-        print('Wert 0: {}'.format(values[0]))
-        print('Wert 1: {}'.format(values[1]))
-
-def printUBABetriebszeit(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'totalRuntime': values[0] << 16 | values[1],
-    }
-    if printing:
-        print('Gesamtbetriebszeit: {} min'.format(parsed['totalRuntime']))
-    return(parsed)
-
-def printRCOutdoorTempMessage(values):
-    parsed = {
-        'timestamp': datetime.today().isoformat(),
-        'dampedOutdoorTemp': values[0],
-    }
-    if printing:
-        print('Gedämpfte Außentemperatur: {} °C'.format(parsed['dampedOutdoorTemp']))
-        print('Flags 1                  : {}'.format(values[1]))
-        print('Flags 2                  : {}'.format(values[2]))
-    return(parsed)
-
-def printUBAParameterWW(values):
-    if printing:
-        print('Warmwassersystem vorhanden            : {}'.format('Ja' if values[0] & 0x08 else 'Nein'))
-        print('Warmwasser am Kessel aktiviert        : {}'.format('Ja' if values[1] == 0xff else 'Nein'))
-        print('Warmwasser Solltemperatur             : {} °C'.format(values[2]))
-        print('Zirkulationspumpe vorhanden           : {}'.format('Ja' if values[3] == 0xff else 'Nein'))
-        print('Schaltzyklus Zirkulationspumpe        : {} min'.format(values[4] * 3))
-        print('Solltemperatur thermische Desinfektion: {} °C'.format(values[5]))
-        print('Warmwassermodus am Kessel             : {}'.format('ECO' if values[6] == 0xdb else 'Comfort'))
-        print('Art des Warmwassersystems             : {}'.format('3-W Ventil' if values[7] == 0xff else 'Ladepumpe'))
-
-def printUBAErrorMessages(values):
-    if printing:
-        print('Displaycode                : {}'.format(values[0].decode('ASCII')))
-        print('Fehlernummer               : {} (0x{:02x})'.format(values[1], values[1]))
-        print('Zeitstempel                : {:04d}-{:02d}-{:02d} {:02d}:{:02d}'.format(
-            (values[2] & 0x7f) + 2000, values[3], values[5], values[4], values[6]))
-        print('Dauer                      : {} min'.format(values[7]))
-        print('Busadresse der Fehlerquelle: 0x{:02x}'.format(values[8]))
-
-def printUBADevices(values):
-    parsed = {}
-    if printing:
-        print('Only present devices will be listed.')
-    for byte_no in range(len(values)):
-        byte = values[byte_no]
-        for bit_no in range(8):
-            num = '{:02d}'.format(byte_no * 8 + bit_no)
-            present = bool(byte & (0x01 << bit_no))
-            parsed['device' + num] = present
-            if printing and present:
-                print('Device {}: Present'.format(num))
-    return(parsed)
 
+def print_devices(parsed):
+    print('Only present devices will be listed.')
+    for name, present in parsed.items():
+        if present:
+            print('Device {}: Present'.format(name[6:]))
+
+def rc300_monitor(circuit):
+    """The EMS+ monitor message of heating circuit 1 to 4 of an RC300/RC310"""
+    hc = 'HC{}'.format(circuit)
+    return({'id': 0xff01a4 + circuit, 'name': 'RC300Monitor{}'.format(hc), 'short': 'rc300_hc{}'.format(circuit),
+            'source': 'thermostat', 'len': 11, 'fields': [
+        field('roomTempIs', 0, 's16', scale=0.1, sentinel=-32768, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='{} Room current temperature'.format(hc), label='Raumtemperatur Ist'),
+        field('summerMode', 2, 'bool', mask=0x10,
+              entity='binary_sensor', description='{} Summer mode'.format(hc), label='Sommerbetrieb'),
+        field('roomTempSet', 3, scale=0.5, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='{} Room set temperature'.format(hc), label='Raumtemperatur Soll'),
+        field('flowTempSet', 4, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='{} Forward flow set temperature'.format(hc), label='Vorlauf Solltemperatur'),
+        field('automatic', 10, 'bool', mask=0x01,
+              entity='binary_sensor', description='{} Automatic mode'.format(hc), label='Automatikbetrieb'),
+        field('dayMode', 10, 'bool', mask=0x02,
+              entity='binary_sensor', description='{} Day mode'.format(hc), label='Tagbetrieb'),
+    ]})
 
+# https://domoticproject.com/ems-bus-buderus-nefit-boiler/#0x18_8211UBA_Monitor_Fast
+# https://emswiki.thefischer.net/doku.php?id=wiki:ems:telegramme#ubamonitorfast
 messagedefinitions = [
-    {'id': 0x06, 'name': 'RCTimeMessage', 'short': 'rc_time', 'len': 8, 'format': '>BBBBBBBB', 'print': printRCTimeMessage},
-    {'id': 0x07, 'name': 'UBADevices', 'len': 12, 'format': '>BBBBBBBBBBBB', 'print': printUBADevices},
-    {'id': 0x10, 'name': 'UBAErrorMessages1', 'len': 12, 'format': '>2sHBBBBBHB', 'print': printUBAErrorMessages},
-    {'id': 0x11, 'name': 'UBAErrorMessages2', 'len': 12, 'format': '>2sHBBBBBHB', 'print': printUBAErrorMessages},
-    {'id': 0x12, 'name': 'RCErrorMessages', 'len': 12, 'format': '>2sHBBBBBHB', 'print': printUBAErrorMessages},
-    {'id': 0x14, 'name': 'UBABetriebszeit', 'len': 3, 'format': '>BH', 'print': printUBABetriebszeit},
-    {'id': 0x18, 'name': 'UBAMonitorFast', 'short': 'uba_fast', 'len': 25, 'format': '>bhBBxxBxhhhHB2sHhx', 'print': printUBAMonitorFast},
-    {'id': 0x19, 'name': 'UBAMonitorSlow', 'short': 'uba_slow', 'len': 25, 'format': '>hhhxxxBBHBHBHBHBH', 'print': printUBAMonitorSlow},
-    {'id': 0x1a, 'name': 'UBASollwerte', 'short': 'uba_setvalues', 'len': 4, 'format': '>bBBB', 'print': printUBASollwerte},
-    {'id': 0x1c, 'name': 'UBAWartungsmeldung', 'len': 28, 'format': '', 'print': None},
-    {'id': 0xa2, 'name': 'Unknown 0x29', 'short': '', 'len': 1, 'format': '>B', 'print': None},
-    {'id': 0x2a, 'name': 'Unknown 0x2A', 'len': 24, 'format': '', 'print': None},
-    {'id': 0x33, 'name': 'UBAParameterWW', 'len': 11, 'format': '>BBbxxxBBbBB', 'print': printUBAParameterWW},
-    {'id': 0x34, 'name': 'UBAMonitorWWMessage', 'short': 'uba_dw', 'len': 16, 'format': '>bhhBBBBBBHBH', 'print': printUBAMonitorWWMessage},
-    {'id': 0x35, 'name': 'Flags', 'len': 2, 'format': '>BB', 'print': printFlags},
-    {'id': 0x3e, 'name': 'Monitor Heating Circuit 1', 'short': 'hk1', 'len': 15, 'format': '>BBbhBBbbbHBBb', 'print': printHK1MonitorMessage},
-    {'id': 0xa2, 'name': 'Unknown 0xA2', 'short': '', 'len': 10, 'format': '>BBBBBBBBBB', 'print': None},
-    {'id': 0xa3, 'name': 'RCOutdoorTempMessage', 'len': 3, 'format': '>bBB', 'print': printRCOutdoorTempMessage},
-    {'id': 0xa5, 'name': 'Unknown 0xA5', 'len': 28, 'format': '', 'print': None},
+    {'id': 0x06, 'name': 'RCTimeMessage', 'short': 'rc_time', 'source': 'thermostat', 'len': 8, 'fields': [
+        field('time', 0, 'datetime', label='Zeit'),
+        field('dayOfWeek', 6, names=wochentage, label='Wochentag'),
+        field('summerTime', 7, 'bool', mask=0x01, label='Sommerzeit'),
+        field('radioClock', 7, 'bool', mask=0x02, label='Funkuhr'),
+        field('timeBad', 7, 'bool', mask=0x04, label='Uhrzeit fehlerhaft'),
+        field('dateBad', 7, 'bool', mask=0x08, label='Datum fehlerhaft'),
+        field('clockRunning', 7, 'bool', mask=0x10, label='Uhr läuft'),
+    ]},
+    {'id': 0x07, 'name': 'UBADevices', 'short': 'uba_devices', 'source': 'boiler', 'len': 12, 'print': print_devices, 'fields': [
+        field('device{:02d}'.format(n), n // 8, 'bool', mask=1 << (n % 8)) for n in range(12 * 8)
+    ]},
+    {'id': 0x10, 'name': 'UBAErrorMessages1', 'len': 12, 'fields': 'UBAErrorMessages'},
+    {'id': 0x11, 'name': 'UBAErrorMessages2', 'len': 12, 'fields': 'UBAErrorMessages'},
+    {'id': 0x12, 'name': 'RCErrorMessages', 'len': 12, 'fields': 'UBAErrorMessages'},
+    {'id': 0x14, 'name': 'UBABetriebszeit', 'short': 'uba_runtime', 'source': 'boiler', 'len': 3, 'fields': [
+        field('totalRuntime', 0, 'u24', unit=DURATION_MINUTES, label='Gesamtbetriebszeit'),
+    ]},
+    {'id': 0x18, 'name': 'UBAMonitorFast', 'short': 'uba_fast', 'source': 'boiler', 'len': 25, 'fields': [
+        field('flowTempSet', 0, 's8', unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Forward flow set temperature', label='Vorlauf Solltemperatur'),
+        field('flowTempIs', 1, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Forward flow current temperature', label='Vorlauf Isttemperatur'),
+        field('burnPowSet', 3, unit=PERCENT,
+              entity='sensor', description='Burner set power', label='Kessel maximale Leistung'),
+        field('burnPowIs', 4, unit=PERCENT,
+              entity='sensor', description='Burner current power', label='Kessel aktuelle Leistung'),
+        field('gasValve1', 7, 'bool', mask=0x01, device_class=DEVICE_CLASS_OPENING,
+              entity='binary_sensor', description='Gas valve stage 1', label='Magnetventil für 1. Stufe'),
+        field('gasValve2', 7, 'bool', mask=0x02, device_class=DEVICE_CLASS_OPENING,
+              entity='binary_sensor', description='Gas valve stage 2', label='Magnetventil für 2. Stufe'),
+        field('fan', 7, 'bool', mask=0x04,
+              entity='binary_sensor', description='Ventilation', label='Gebläse'),
+        field('ignition', 7, 'bool', mask=0x08,
+              entity='binary_sensor', description='Ignition', label='Zündung'),
+        field('boilerPump', 7, 'bool', mask=0x20,
+              entity='binary_sensor', description='Boiler pump', label='Kesselkreispumpe'),
+        field('valveDrinkWater', 7, 'bool', mask=0x40,
+              entity='binary_sensor', description='Valve set to drinkwater heating', label='3-Wege-Ventil auf Warmwasser'),
+        field('drinkWaterCircPump', 7, 'bool', mask=0x80,
+              entity='binary_sensor', description='Drink water circulation pump', label='Zirkulation'),
+        field('boilerTemp', 9, 's16', scale=0.1, sentinel=-32768, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Boiler current temperature', label='Temperatur (DL-Erhitzer?)'),
+        field('drinkWaterTemp', 11, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Drinkwater temperature', label='Wassertemperatur'),
+        field('flowReturnTemp', 13, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Return flow temperature', label='Temperatur Rücklauf'),
+        field('flameCurrent', 15, 'u16', scale=0.1, unit=CURRENT_MILLIAMPS, device_class=DEVICE_CLASS_POWER,
+              entity='sensor', description='Flame current', label='Flammenstrom'),
+        field('systemPressure', 17, scale=0.1, unit=PRESSURE_BAR, device_class=DEVICE_CLASS_PRESSURE,
+              entity='sensor', description='System water pressure', label='Systemdruck'),
+        field('serviceCode', 18, 'str2', description='Service code', label='Service code'),
+        field('errorCode', 20, 'u16', description='Error code', label='Error code'),
+        field('intakeTemp', 22, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Intake air temperature', label='Ansauglufttemperatur'),
+    ]},
+    {'id': 0x19, 'name': 'UBAMonitorSlow', 'short': 'uba_slow', 'source': 'boiler', 'len': 25, 'fields': [
+        field('outsideTemp', 0, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Outside temperature', label='Außentemperatur'),
+        field('boilerTemp', 2, 's16', scale=0.1, sentinel=-32768, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Boiler temperature', label='Kessel-Ist-Temperatur'),
+        field('exhaustTemp', 4, 's16', scale=0.1, sentinel=-32768, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Exhaust temperature', label='Abgastemperatur'),
+        field('pumpMod', 9, unit=PERCENT,
+              entity='sensor', description='Pump modulation', label='Pumpenmodulation'),
+        field('burnStarts', 10, 'u24',
+              entity='sensor', description='Burner starts', label='Brennerstarts'),
+        field('burnOperTot', 13, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Burner operation time', label='Betriebszeit komplett (Brenner)'),
+        field('burnOperStage2', 16, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Burner stage 2 operation time', label='Betriebszeit Brenner Stufe 2'),
+        field('burnOperHeat', 19, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Burner heating time', label='Betriebszeit heizen'),
+        field('burnOperDrinkWater', 22, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Burner drinkwater operation time', label='Noch eine Zeit'),
+    ]},
+    {'id': 0x1a, 'name': 'UBASollwerte', 'short': 'uba_setvalues', 'source': 'thermostat', 'len': 4, 'fields': [
+        field('boilerTempSet', 0, 's8', unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Boiler set temperature', label='Kessel-Solltemperatur'),
+        field('requestedPowerHeating', 1, unit=PERCENT,
+              entity='sensor', description='Requested heating power', label='Leistungsanforderung HK'),
+        field('requestedPowerDrinkwater', 2, unit=PERCENT,
+              entity='sensor', description='Requested drinkwater power', label='Leistungsanforderung WW'),
+        field('alwaysZero', 3, label='Immer 0'),
+    ]},
+    {'id': 0x1c, 'name': 'UBAWartungsmeldung', 'len': 28, 'fields': []},
+    {'id': 0x29, 'name': 'Unknown 0x29', 'len': 1, 'fields': []},
+    {'id': 0x2a, 'name': 'Unknown 0x2A', 'len': 24, 'fields': []},
+    {'id': 0x33, 'name': 'UBAParameterWW', 'len': 11, 'fields': [
+        field('systemPresent', 0, 'bool', mask=0x08, names=janein, label='Warmwassersystem vorhanden'),
+        field('enabled', 1, 'bool', equals=0xff, names=janein, label='Warmwasser am Kessel aktiviert'),
+        field('tempSet', 2, 's8', unit=TEMP_CELSIUS, label='Warmwasser Solltemperatur'),
+        field('circPumpPresent', 6, 'bool', equals=0xff, names=janein, label='Zirkulationspumpe vorhanden'),
+        field('circPumpInterval', 7, scale=3, unit=DURATION_MINUTES, label='Schaltzyklus Zirkulationspumpe'),
+        field('desinfectTemp', 8, 's8', unit=TEMP_CELSIUS, label='Solltemperatur thermische Desinfektion'),
+        # 0xdb is ECO, anything else comfort
+        field('ecoMode', 9, 'bool', equals=0xdb, names=('Comfort', 'ECO'), label='Warmwassermodus am Kessel'),
+        # 0xff is a 3-way valve, anything else a charge pump
+        field('valve', 10, 'bool', equals=0xff, names=('Ladepumpe', '3-W Ventil'), label='Art des Warmwassersystems'),
+    ]},
+    {'id': 0x34, 'name': 'UBAMonitorWWMessage', 'short': 'uba_dw', 'source': 'boiler', 'len': 16, 'fields': [
+        field('tempSet', 0, 's8', unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Drinkwater set temperature', label='Warmwasser Temperatur Soll'),
+        field('sensor1tempIs', 1, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Drinkwater current temperature sensor 1', label='Warmwasser Temperatur Ist'),
+        field('sensor2TempIs', 3, 's16', scale=0.1, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Drinkwater current temperature sensor 1', label='Warmwasser Temperatur Ist 2. Fühler'),
+        field('dayMode', 5, 'bool', mask=0x01,
+              entity='binary_sensor', description='Day Mode', label='Tagbetrieb'),
+        field('singleHeat', 5, 'bool', mask=0x02,
+              entity='binary_sensor', description='One shot drinkwater heat', label='Einmalladung'),
+        field('thermDesinfect', 5, 'bool', mask=0x04,
+              entity='binary_sensor', description='Thermal desinfection', label='Thermische Desinfektion'),
+        field('heatingEnabled', 5, 'bool', mask=0x08,
+              entity='binary_sensor', description='Drinkwater heating', label='Warmwasserbereitung'),
+        field('reHeat', 5, 'bool', mask=0x10,
+              entity='binary_sensor', description='Drinkwater reheating', label='Warmwassernachladung'),
+        field('setTempReached', 5, 'bool', mask=0x20,
+              entity='binary_sensor', description='Drinkwater temperature okay', label='Warmwasser-Temperatur OK'),
+        field('sensor1Error', 6, 'bool', mask=0x01,
+              entity='binary_sensor', description='Drinkwater sensor 1 error', label='Fühler 1 defekt'),
+        field('sensor2Error', 6, 'bool', mask=0x02,
+              entity='binary_sensor', description='Drinkwater sensor 2 error', label='Fühler 2 defekt'),
+        field('generalError', 6, 'bool', mask=0x04,
+              entity='binary_sensor', description='Drinkwater heating error', label='Störung WW'),
+        field('desinfectError', 6, 'bool', mask=0x08,
+              entity='binary_sensor', description='Drinkwater desinfection error', label='Störung Desinfektion'),
+        field('circDayMode', 7, 'bool', mask=0x01,
+              entity='binary_sensor', description='Drinkwater day mode circulation', label='Zirkulation Tagbetrieb'),
+        field('circManual', 7, 'bool', mask=0x02,
+              entity='binary_sensor', description='Drinkwater manual circulation', label='Zirkulation Manuell gestartet'),
+        field('circOn', 7, 'bool', mask=0x04,
+              entity='binary_sensor', description='Drinkwater enabled', label='Zirkulation läuft'),
+        field('heatingNow', 7, 'bool', mask=0x08,
+              entity='binary_sensor', description='Drinkwater currently heating', label='Ladevorgang WW läuft'),
+        field('systemType', 8, names=warmwassersysteme,
+              entity='sensor', description='Drinkwater system type', label='Art des Warmwassersystems'),
+        field('currentFlow', 9, scale=0.1, unit=LITERS_PER_MINUTE,
+              entity='sensor', description='Drinkwater current flow', label='Warmwasser Durchfluss'),
+        field('heatingTime', 10, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Drinkwater heating time', label='Warmwasserbereitungszeit'),
+        field('heatingRuns', 13, 'u24',
+              entity='sensor', description='Drinkwater heating cycles', label='Warmwasserbereitungen'),
+    ]},
+    {'id': 0x35, 'name': 'Flags', 'len': 2, 'fields': [
+        field('value0', 0, label='Wert 0'),
+        field('value1', 1, label='Wert 1'),
+    ]},
+    {'id': 0x3e, 'name': 'Monitor Heating Circuit 1', 'short': 'hk1', 'source': 'thermostat', 'len': 15, 'fields': [
+        field('onOptimize', 0, 'bool', mask=0x01,
+              entity='binary_sensor', description='Optimize turn on', label='Ausschaltoptimierung'),
+        field('offOptimize', 0, 'bool', mask=0x02,
+              entity='binary_sensor', description='Optimize turn off', label='Einschaltoptimierung'),
+        field('automatic', 0, 'bool', mask=0x04,
+              entity='binary_sensor', description='Automatic mode', label='Automatikbetrieb'),
+        field('preferDrinkwater', 0, 'bool', mask=0x08,
+              entity='binary_sensor', description='Prefer drink water heating', label='WW-Vorrang'),
+        field('screedDrying', 0, 'bool', mask=0x10,
+              entity='binary_sensor', description='Screed drying', label='Estrichtrocknung'),
+        field('vacationMode', 0, 'bool', mask=0x20,
+              entity='binary_sensor', description='Vacation mode', label='Urlaubsbetrieb'),
+        field('frostProtection', 0, 'bool', mask=0x40,
+              entity='binary_sensor', description='Frost protection mode', label='Frostschutz'),
+        field('manual', 0, 'bool', mask=0x80,
+              entity='binary_sensor', description='Manual mode', label='Manuell'),
+        field('summerMode', 1, 'bool', mask=0x01,
+              entity='binary_sensor', description='Summer mode', label='Sommerbetrieb'),
+        field('dayMode', 1, 'bool', mask=0x02,
+              entity='binary_sensor', description='Day mode', label='Tagbetrieb'),
+        field('remoteDisconnected', 1, 'bool', mask=0x04,
+              entity='binary_sensor', description='Remote disconnected', label='Keine Kommunikation mit FB (?)'),
+        field('remoteError', 1, 'bool', mask=0x08,
+              entity='binary_sensor', description='Remote Error', label='FB fehlerhaft (?)'),
+        field('forwardFlowSensorError', 1, 'bool', mask=0x10,
+              entity='binary_sensor', description='Forward flow sensor error', label='Fehler Vorlauffühler (?)'),
+        field('maxForwardFlow', 1, 'bool', mask=0x20,
+              entity='binary_sensor', description='Maximum forward flow', label='Maximaler Vorlauf'),
+        field('externalError', 1, 'bool', mask=0x40,
+              entity='binary_sensor', description='External error', label='Externer Störeingang (?)'),
+        field('partyPauseMode', 1, 'bool', mask=0x80,
+              entity='binary_sensor', description='Party pause mode', label='Party- Pausebetrieb'),
+        field('roomTempSet', 2, 's8', scale=0.5, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='HC1 Room set temperature', label='Raumtemperatur Soll'),
+        field('roomTempIs', 3, 's16', scale=0.1, sentinel=32000, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='HC1 Room current temperature', label='Raumtemperatur Ist'),
+        field('onOptimizeTime', 5, unit=DURATION_MINUTES,
+              description='HC1 Turn on optimization time', label='Einschaltoptimierungszeit'),
+        field('offOptimizeTime', 6, unit=DURATION_MINUTES,
+              description='HC1 Turn off optimization time', label='Ausschaltoptimierungszeit'),
+        field('heatingCurve10Deg', 7, 's8', unit=TEMP_CELSIUS, label='Heizkreis1 Heizkurve 10°C'),
+        field('heatingCurve0Deg', 8, 's8', unit=TEMP_CELSIUS, label='Heizkreis1 Heizkurve 0°C'),
+        field('heatingCurveMinus10Deg', 9, 's8', unit=TEMP_CELSIUS, label='Heizkreis1 Heizkurve -10°C'),
+        field('roomTempAdaptionTime', 10, 'u16', scale=0.01,
+              description='HC1 Room temperature adaption time', label='Raumtemperatur-Änderungsgeschwindigkeit'),
+        field('requestedBoilerPower', 12, unit=PERCENT,
+              description='HC1 Requested boiler power', label='Von diesem Heizkreis angeforderte Kesselleistung'),
+        field('state0', 13, 'bool', mask=0x01, label='Schaltzustand ???'),
+        field('state1', 13, 'bool', mask=0x02, label='Schaltzustand ???'),
+        field('stateParty', 13, 'bool', mask=0x04, label='Schaltzustand Party'),
+        field('statePause', 13, 'bool', mask=0x08, label='Schaltzustand Pause'),
+        field('state4', 13, 'bool', mask=0x10, label='Schaltzustand ???'),
+        field('state5', 13, 'bool', mask=0x20, label='Schaltzustand ???'),
+        field('stateVacation', 13, 'bool', mask=0x40, label='Schaltzustand Urlaub'),
+        field('stateHoliday', 13, 'bool', mask=0x80, label='Schaltzustand Ferien'),
+        field('calculatedForwardTemp', 14, 's8', unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='HC1 Calculated forward flow temperature', label='Berechnete Solltemperatur Vorlauf'),
+    ]},
+    {'id': 0xa2, 'name': 'Unknown 0xA2', 'len': 10, 'fields': []},
+    {'id': 0xa3, 'name': 'RCOutdoorTempMessage', 'short': 'rc_outdoortemp', 'source': 'thermostat', 'len': 3, 'fields': [
+        field('dampedOutdoorTemp', 0, 's8', unit=TEMP_CELSIUS, label='Gedämpfte Außentemperatur'),
+        field('flags1', 1, label='Flags 1'),
+        field('flags2', 2, label='Flags 2'),
+    ]},
+    {'id': 0xa5, 'name': 'Unknown 0xA5', 'len': 28, 'fields': []},
+    # EMS+ messages have the type 0xFF followed by a 16 bit extended type, so their id
+    # is 0xff0000 | extended type. They grow with the firmware, len only covers the
+    # known fields. Offsets as in EMS-ESP.
+    {'id': 0xff00e4, 'name': 'UBAMonitorFastPlus', 'short': 'uba_fast_plus', 'source': 'boiler', 'len': 21, 'fields': [
+        field('serviceCodeNumber', 4, 'u16', description='Service code number', label='Servicecode Nummer'),
+        field('flowTempSet', 6, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Forward flow set temperature', label='Vorlauf Solltemperatur'),
+        field('flowTempIs', 7, 's16', scale=0.1, sentinel=-32768, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Forward flow current temperature', label='Vorlauf Isttemperatur'),
+        field('burnPowSet', 9, unit=PERCENT,
+              entity='sensor', description='Burner set power', label='Kessel maximale Leistung'),
+        field('burnPowIs', 10, unit=PERCENT,
+              entity='sensor', description='Burner current power', label='Kessel aktuelle Leistung'),
+        field('burnGas', 11, 'bool', mask=0x01, device_class=DEVICE_CLASS_OPENING,
+              entity='binary_sensor', description='Gas valve', label='Gasventil'),
+        field('drinkWaterHeating', 11, 'bool', mask=0x04,
+              entity='binary_sensor', description='Drink water heating', label='Warmwasserbereitung'),
+        field('flameCurrent', 19, 'u16', scale=0.1, unit=CURRENT_MILLIAMPS, device_class=DEVICE_CLASS_POWER,
+              entity='sensor', description='Flame current', label='Flammenstrom'),
+    ]},
+    {'id': 0xff00e5, 'name': 'UBAMonitorSlowPlus', 'short': 'uba_slow_plus', 'source': 'boiler', 'len': 26, 'fields': [
+        field('fan', 2, 'bool', mask=0x04,
+              entity='binary_sensor', description='Ventilation', label='Gebläse'),
+        field('ignition', 2, 'bool', mask=0x08,
+              entity='binary_sensor', description='Ignition', label='Zündung'),
+        field('heatingPump', 2, 'bool', mask=0x20,
+              entity='binary_sensor', description='Heating pump', label='Heizungspumpe'),
+        field('drinkWaterCircPump', 2, 'bool', mask=0x80,
+              entity='binary_sensor', description='Drink water circulation pump', label='Zirkulation'),
+        field('exhaustTemp', 6, 's16', scale=0.1, sentinel=-32768, unit=TEMP_CELSIUS, device_class=DEVICE_CLASS_TEMPERATURE,
+              entity='sensor', description='Exhaust temperature', label='Abgastemperatur'),
+        field('burnStarts', 10, 'u24',
+              entity='sensor', description='Burner starts', label='Brennerstarts'),
+        field('burnOperTot', 13, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Burner operation time', label='Betriebszeit komplett (Brenner)'),
+        field('burnOperHeat', 19, 'u24', unit=DURATION_MINUTES,
+              entity='sensor', description='Burner heating time', label='Betriebszeit heizen'),
+        field('pumpMod', 25, unit=PERCENT,
+              entity='sensor', description='Pump modulation', label='Pumpenmodulation'),
+    ]},
+    *[rc300_monitor(circuit) for circuit in range(1, 5)],
 ]
 
+# Fields shared by several messages
+messagefields = {
+    'UBAErrorMessages': [
+        field('displayCode', 0, 'str2', label='Displaycode'),
+        field('errorNumber', 2, 'u16', label='Fehlernummer'),
+        field('time', 4, 'datetime5', label='Zeitstempel'),
+        field('duration', 9, 'u16', unit=DURATION_MINUTES, label='Dauer'),
+        field('source', 11, label='Busadresse der Fehlerquelle'),
+    ],
+}
+
+def ems_datetime(year, month, day, hour, minute, second=0):
+    """Return the ISO format of a time sent on the bus, or None if it is not valid"""
+    try:
+        return(datetime(year, month, day, hour, minute, second).isoformat())
+    except ValueError:
+        return(None)
+
+def _field_expression(fielddef, index):
+    """Python expression that computes the value of a field from the unpacked values v"""
+    fieldtype = fielddef['type']
+    raw = 'v[{}]'.format(index)
+    if fieldtype == 'str2':
+        return("{}.decode('ASCII')".format(raw))
+    if fieldtype == 'datetime':
+        return('_datetime(v[{}] + 2000, v[{}], v[{}], v[{}], v[{}], v[{}])'.format(
+            index, index + 1, index + 3, index + 2, index + 4, index + 5))
+    if fieldtype == 'datetime5':
+        return('_datetime((v[{}] & 0x7f) + 2000, v[{}], v[{}], v[{}], v[{}])'.format(
+            index, index + 1, index + 3, index + 2, index + 4))
+    if fieldtype == 'u24':
+        raw = '(v[{}] << 16 | v[{}])'.format(index, index + 1)
+    if fieldtype == 'bool':
+        if fielddef['equals'] is not None:
+            return('{} == 0x{:02x}'.format(raw, fielddef['equals']))
+        return('bool({} & 0x{:02x})'.format(raw, fielddef['mask'] if fielddef['mask'] else 0xff))
+    if fielddef['mask']:
+        raw = '({} & 0x{:02x})'.format(raw, fielddef['mask'])
+    value = raw
+    scale = fielddef['scale']
+    if scale:
+        # Divide by integers where possible, 501 / 10 gives a nicer float than 501 * 0.1.
+        if scale < 1 and (1 / scale) == round(1 / scale):
+            value = '{} / {}'.format(raw, round(1 / scale))
+        else:
+            value = '{} * {!r}'.format(raw, scale)
+    if fielddef['sentinel'] is not None:
+        value = 'None if {} == {!r} else {}'.format(raw, fielddef['sentinel'], value)
+    return(value)
+
+def compile_decoder(msgdef):
+    """Generate the struct and the decoder function of a message from its fields
+
+    All fields are unpacked with a single struct. Fields at the same offset share the
+    unpacked value. The generated function decode(data, base) unpacks the payload
+    starting at data[base] and returns a dict of all values.
+    """
+    slots = sorted({(f['offset'], FIELD_TYPES[f['type']]) for f in msgdef['fields']})
+    fmt = '>'
+    pos = 0
+    count = 0
+    index = {}
+    for offset, code in slots:
+        if offset < pos:
+            raise ValueError('Overlapping fields at offset {} in {}'.format(offset, msgdef['name']))
+        fmt += 'x' * (offset - pos)
+        index[(offset, code)] = count
+        count += len(struct.unpack('>' + code, bytes(struct.calcsize('>' + code))))
+        fmt += code
+        pos = offset + struct.calcsize('>' + code)
+    if pos > msgdef['len']:
+        raise ValueError('Fields of {} exceed its length'.format(msgdef['name']))
+    fmt += 'x' * (msgdef['len'] - pos)
+    unpacker = struct.Struct(fmt)
+
+    source = 'def decode(data, base):\n    v = unpack_from(data, base)\n    return({\n'
+    for f in msgdef['fields']:
+        source += '        {!r}: {},\n'.format(f['name'], _field_expression(f, index[(f['offset'], FIELD_TYPES[f['type']])]))
+    source += '    })\n'
+
+    # update(record, data, base) stores the values in the slots of a Record and returns
+    # the changed ones. All values are computed before the first is stored, so a failing
+    # decode leaves the record as it was.
+    source += 'def update(r, data, base):\n    v = unpack_from(data, base)\n'
+    for number, f in enumerate(msgdef['fields']):
+        source += '    x{} = {}\n'.format(number, _field_expression(f, index[(f['offset'], FIELD_TYPES[f['type']])]))
+    source += '    c = {}\n'
+    for number, f in enumerate(msgdef['fields']):
+        source += '    if x{0} != r.{1}:\n        r.{1} = c[{1!r}] = x{0}\n'.format(number, f['name'])
+    source += '    return(c)\n'
+    namespace = {'unpack_from': unpacker.unpack_from, '_datetime': ems_datetime}
+    exec(compile(source, '<decoder {}>'.format(msgdef['name']), 'exec'), namespace)
+    return(unpacker, namespace['decode'], namespace['update'])
+
+def compile_field_decoders(msgdef):
+    """Generate a decoder per field for partial telegrammes.
+
+    Returns a list of (first byte, end byte, name, decode(payload)) where decode unpacks
+    the field from a payload image starting at offset 0.
+    """
+    decoders = []
+    for f in msgdef['fields']:
+        code = FIELD_TYPES[f['type']]
+        unpacker = struct.Struct('>' + code)
+        source = 'def decode(data):\n    v = unpack_from(data, {})\n    return({})\n'.format(
+            f['offset'], _field_expression(f, 0))
+        namespace = {'unpack_from': unpacker.unpack_from, '_datetime': ems_datetime}
+        exec(compile(source, '<decoder {}.{}>'.format(msgdef['name'], f['name']), 'exec'), namespace)
+        decoders.append((f['offset'], f['offset'] + unpacker.size, f['name'], namespace['decode']))
+    return(decoders)
+
+# Value of a field that has not been received yet
+UNSET = type('Unset', (), {'__repr__': lambda self: 'UNSET', '__bool__': lambda self: False})()
+
+class Record:
+    """The values of a section, one slot per field, and when they last changed.
+
+    address is the bus address the values come from. version is the StateStore version of
+    the last change, 0 if nothing has been received. monotonic and epoch are
+    time.monotonic() and time.time() of the last change. stale is True while the values
+    are restored ones and nothing has been received yet. image is the payload assembled
+    from partial telegrammes and known the bit mask of its received bytes, see
+    StateStore.patch(). The class attributes base and msgtype are the section and type of
+    the message definition.
+    """
+    __slots__ = ('section', 'address', 'version', 'monotonic', 'epoch', 'stale', 'image', 'known')
+    fields = ()
+    base = None
+    msgtype = None
+
+    def __init__(self, section=None, address=None):
+        for name in self.fields:
+            setattr(self, name, UNSET)
+        self.section = section or self.base
+        self.address = address
+        self.version = 0
+        self.monotonic = None
+        self.epoch = None
+        self.stale = False
+        self.image = None
+        self.known = 0
+
+    def get(self, name, default=None):
+        value = getattr(self, name, UNSET)
+        return(default if value is UNSET else value)
+
+    def items(self):
+        """The received values as (name, value)"""
+        for name in self.fields:
+            value = getattr(self, name)
+            if value is not UNSET:
+                yield name, value
+
+    def as_dict(self):
+        """The received values and the time of the last change as an ISO string in 'timestamp'"""
+        values = dict(self.items())
+        if self.epoch is not None:
+            values['timestamp'] = datetime.fromtimestamp(self.epoch).isoformat()
+        if self.stale:
+            values['stale'] = True
+        return(values)
+
+def compile_record(msgdef):
+    """Generate the Record class of a message, with a slot per field"""
+    names = tuple(f['name'] for f in msgdef['fields'])
+    for name in names:
+        if not name.isidentifier() or name in Record.__slots__:
+            raise ValueError('Field name {} of {} cannot be a slot'.format(name, msgdef['name']))
+    return(type(re.sub(r'\W', '', msgdef['name']) + 'Record', (Record,), {
+        '__slots__': names, 'fields': names, 'base': msgdef.get('short'), 'msgtype': msgdef['id']}))
+
+def compile_messagedefinitions(definitions):
+    """Index the message definitions by type id and generate their decoders.
+
+    The ids of EMS+ messages are above 0xff, so both kinds share the index.
+    """
+    types = {}
+    for msgdef in definitions:
+        if msgdef['id'] in types:
+            raise ValueError('Duplicate message definition for type 0x{:02x}'.format(msgdef['id']))
+        if isinstance(msgdef['fields'], str):
+            msgdef['fields'] = messagefields[msgdef['fields']]
+        if msgdef['fields']:
+            msgdef['struct'], msgdef['decode'], msgdef['update'] = compile_decoder(msgdef)
+            msgdef['record'] = compile_record(msgdef)
+            msgdef['fielddecoders'] = compile_field_decoders(msgdef)
+            # Bit mask of the payload bytes holding fields, as in Record.known
+            msgdef['fieldmask'] = 0
+            for first, last, name, decode in msgdef['fielddecoders']:
+                msgdef['fieldmask'] |= ((1 << (last - first)) - 1) << first
+        else:
+            msgdef['struct'] = msgdef['decode'] = msgdef['update'] = msgdef['record'] = None
+            msgdef['fielddecoders'] = []
+            msgdef['fieldmask'] = 0
+        msgdef['fieldnames'] = {f['name']: f for f in msgdef['fields']}
+        # The header of EMS+ messages ends with the two bytes of the extended type.
+        msgdef['header'] = 6 if msgdef['id'] > 0xff else 4
+        # Length of the whole telegramme: header, payload and CRC
+        msgdef['size'] = msgdef['len'] + msgdef['header'] + 1
+        types[msgdef['id']] = msgdef
+    return(types)
+
+messagetypes = compile_messagedefinitions(messagedefinitions)
+
+class StateStore:
+    """The decoded state, one Record per section.
+
+    The records are updated in place by the generated update function of their message,
+    which only returns the changed values. Dicts and JSON are built on request.
+    version counts the changes of all sections, epoch is the time of the last one.
+    Updates and section_dict() hold a lock, so other threads never see a record that is
+    updated halfway. New records replace the records dict instead of changing it, so it
+    can be iterated from other threads.
+    """
+    def __init__(self, definitions):
+        self._lock = threading.Lock()
+        self._definitions = {msgdef['id']: msgdef for msgdef in definitions if msgdef.get('short') and msgdef['record']}
+        self.clear()
+
+    def clear(self):
+        self.records = {msgdef['short']: msgdef['record']() for msgdef in self._definitions.values()}
+        # Record per (message type, source address), filled in as the sources show up
+        self.routes = {}
+        self.version = 0
+        self.epoch = time.time()
+
+    def __getitem__(self, section):
+        return(self.records[section])
+
+    def __contains__(self, section):
+        return(section in self.records)
+
+    def __iter__(self):
+        return(iter(self.records))
+
+    def record(self, msgdef, source):
+        """Return the record of a message from a source address.
+
+        The first source of the device kind sending the message claims its section, e.g.
+        the first thermostat the section of RCTimeMessage, which the computer also sends
+        when it sets the time. Each further source gets a section of its own, named
+        <section>_<address in hex>, e.g. hk1_17.
+        """
+        record = self.routes.get((msgdef['id'], source))
+        if record is None:
+            with self._lock:
+                record = self._route(msgdef, source)
+        return(record)
+
+    @staticmethod
+    def _claims(msgdef, source):
+        """Whether a source may have the section of a message, i.e. is of its device kind"""
+        addresses = DEVICE_ADDRESSES.get(msgdef.get('source'))
+        return(addresses is None or source in addresses)
+
+    def _route(self, msgdef, source):
+        record = self.records[msgdef['short']]
+        if record.address not in (None, source) or not self._claims(msgdef, source):
+            section = '{}_{:02x}'.format(msgdef['short'], source)
+            record = self.records.get(section)
+            if record is None:
+                record = msgdef['record'](section)
+                self.records = dict(self.records, **{section: record})
+        record.address = source
+        self.routes[(msgdef['id'], source)] = record
+        return(record)
+
+    def update(self, record, msgdef, data, base=4):
+        """Decode a telegramme into a record and return the changed values.
+
+        The first telegramme after a restore returns all values, so their consumers learn
+        that they are current again.
+        """
+        with self._lock:
+            changes = msgdef['update'](record, data, base)
+            # The next partial telegramme starts from this one.
+            record.image = None
+            if record.stale:
+                record.stale = False
+                changes = dict(record.items())
+            if changes:
+                self.version += 1
+                record.version = self.version
+                record.monotonic = time.monotonic()
+                record.epoch = self.epoch = time.time()
+        return(changes)
+
+    def patch(self, record, msgdef, offset, payload, full=None):
+        """Apply a partial telegramme and return the changed values.
+
+        payload is written at offset into the image of the record, which starts as the
+        payload of full, the last complete telegramme, or as nothing known. Only the fields
+        touched by the payload are decoded, and only if all their bytes are known. After a
+        restore, the decoded fields are returned even if unchanged, and the record is stale
+        until the image holds all fields.
+        """
+        length = msgdef['len']
+        end = min(offset + len(payload), length)
+        if end <= offset:
+            return({})
+        with self._lock:
+            if record.image is None:
+                if full is not None and len(full) >= msgdef['size']:
+                    header = msgdef['header']
+                    record.image = bytearray(full[header:header + length])
+                    record.known = (1 << length) - 1
+                else:
+                    record.image = bytearray(length)
+                    record.known = 0
+            image = record.image
+            image[offset:end] = payload[:end - offset]
+            known = record.known = record.known | ((1 << (end - offset)) - 1) << offset
+            changes = {}
+            stale = record.stale
+            for first, last, name, decode in msgdef['fielddecoders']:
+                if first < end and last > offset:
+                    mask = ((1 << (last - first)) - 1) << first
+                    if known & mask == mask:
+                        value = decode(image)
+                        # Restored values are returned when received again, even if unchanged.
+                        if stale or value != getattr(record, name):
+                            setattr(record, name, value)
+                            changes[name] = value
+            if stale:
+                # The section stays stale until all its fields have been received.
+                record.stale = known & msgdef['fieldmask'] != msgdef['fieldmask']
+            if changes:
+                self.version += 1
+                record.version = self.version
+                record.monotonic = time.monotonic()
+                record.epoch = self.epoch = time.time()
+        return(changes)
+
+    def section_dict(self, section):
+        """Return (version, values) of a section, taken consistently"""
+        record = self.records[section]
+        with self._lock:
+            return(record.version, record.as_dict())
+
+    def as_dict(self):
+        return({section: self.section_dict(section)[1] for section in self.records})
+
+    def dump(self):
+        """Return the received values, their source and the time of their last change per section, for restore()"""
+        with self._lock:
+            return({section: {'type': record.msgtype, 'address': record.address, 'epoch': record.epoch,
+                              'values': dict(record.items())}
+                    for section, record in self.records.items() if record.version})
+
+    def restore(self, data):
+        """Take the values of dump() as stale values. Unknown sections and fields are skipped.
+
+        Values with a source are restored to the section the source is routed to now, see
+        record(), so a section saved with the wrong owner goes back to its device. Returns
+        the restored sections.
+        """
+        restored = []
+        with self._lock:
+            known = [(section, saved, self._definitions.get(saved.get('type'))) for section, saved in data.items()]
+            # Route the sources of the device kind of their message first, as they claim its section.
+            known.sort(key=lambda entry: entry[2] is None or entry[1].get('address') is None
+                       or not self._claims(entry[2], entry[1]['address']))
+            for section, saved, msgdef in known:
+                if msgdef is None:
+                    continue
+                if saved.get('address') is not None:
+                    record = self._route(msgdef, saved['address'])
+                else:
+                    record = self.records.get(section)
+                    if record is None:
+                        record = msgdef['record'](section)
+                        self.records = dict(self.records, **{section: record})
+                if record.version:
+                    continue
+                for name, value in saved['values'].items():
+                    if name in record.fields:
+                        setattr(record, name, value)
+                self.version += 1
+                record.version = self.version
+                record.epoch = saved.get('epoch')
+                record.stale = True
+                restored.append(record.section)
+        return(restored)
+
+state = StateStore(messagedefinitions)
+
+def encode_payload(msgdef, values):
+    """Build the payload of a message from a dict of values, the reverse of its decoder.
+
+    Fields missing in values are sent as 0.
+    """
+    payload = bytearray(msgdef['len'])
+    for f in msgdef['fields']:
+        if f['name'] not in values:
+            continue
+        value = values[f['name']]
+        offset = f['offset']
+        fieldtype = f['type']
+        if fieldtype == 'bool':
+            if value:
+                payload[offset] |= f['equals'] if f['equals'] is not None else f['mask'] if f['mask'] else 0xff
+            continue
+        if fieldtype == 'str2':
+            payload[offset:offset + 2] = value.encode('ASCII')[:2].ljust(2)
+            continue
+        if fieldtype in ('datetime', 'datetime5'):
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            raw = (value.year - 2000, value.month, value.hour, value.day, value.minute, value.second)
+            payload[offset:offset + len(FIELD_TYPES[fieldtype])] = bytes(raw[:len(FIELD_TYPES[fieldtype])])
+            continue
+        if value is None:
+            raw = f['sentinel']
+        elif f['scale']:
+            raw = int(round(value / f['scale']))
+        else:
+            raw = int(value)
+        if fieldtype == 'u24':
+            payload[offset:offset + 3] = raw.to_bytes(3, 'big')
+        elif f['mask']:
+            payload[offset] |= raw & f['mask']
+        else:
+            struct.pack_into('>' + FIELD_TYPES[fieldtype], payload, offset, raw)
+    return(bytes(payload))
+
+def build_telegram(src, dst, msgtype, payload, offset=0):
+    """Return a complete telegramme with CRC, without the BREAK. msgtype may be the id of an EMS+ message."""
+    if msgtype > 0xff:
+        telegram = bytes((src, dst, EMS_PLUS, offset, (msgtype >> 8) & 0xff, msgtype & 0xff)) + payload
+    else:
+        telegram = bytes((src, dst, msgtype, offset)) + payload
+    return(telegram + bytes((crc_calculate(telegram),)))
+
+def entity_definitions(platform):
+    """List the values shown as entities of a platform as [section, name, description, device class, unit]"""
+    return([[msgdef['short'], f['name'], f['description'], f['device_class'], f['unit']]
+            for msgdef in messagedefinitions if msgdef.get('short')
+            for f in msgdef['fields'] if f['entity'] == platform])
+
+def section_entities(platform, section):
+    """entity_definitions() of one section. Sections of further devices name the device in the description."""
+    record = state[section]
+    definitions = [definition for definition in entity_definitions(platform) if definition[0] == record.base]
+    if section != record.base:
+        suffix = ' ({})'.format(devices[record.address].name if record.address is not None else section)
+        definitions = [[section, name, description + suffix, device_class, unit]
+                       for _, name, description, device_class, unit in definitions]
+    return(definitions)
+
+def present_sections():
+    """Return the sections sent by the devices listed in the last UBADevices message.
+
+    Bit n of UBADevices, the value devicenn, stands for bus address n + 8. EMS+ sections
+    are left out, as only their telegrammes tell whether a device speaks EMS+.
+    """
+    devices = state['uba_devices']
+    present = {address for address in range(8, 8 + len(devices.fields))
+               if devices.get('device{:02d}'.format(address - 8))}
+    return({msgdef['short'] for msgdef in messagedefinitions
+            if msgdef.get('short') and msgdef['id'] <= 0xff
+            and present.intersection(DEVICE_ADDRESSES.get(msgdef.get('source'), ()))})
+
+def print_message(msgdef, parsed):
+    """Print the decoded values of a message with their German labels"""
+    if 'print' in msgdef:
+        msgdef['print'](parsed)
+        return()
+    fields = [f for f in msgdef['fields'] if f['label']]
+    width = max((len(f['label']) for f in fields), default=0)
+    for f in fields:
+        value = parsed[f['name']]
+        if f['names'] and isinstance(value, int) and 0 <= value < len(f['names']):
+            text = f['names'][value]
+        elif f['type'] == 'bool':
+            text = 'An' if value else 'Aus'
+        elif f['unit'] and value is not None:
+            text = '{} {}'.format(value, f['unit'])
+        else:
+            text = '{}'.format(value)
+        print('{}: {}'.format(f['label'].ljust(width), text))
+
 def is_set(x, n):
     return x & 2**n != 0
 
@@ -548,150 +1108,829 @@ devicenames = {
     0x6F: 'Gerät 56',
 }
 
-def parse_message(data, hass):
+# Kinds of the devices, referred to by 'source' in the message definitions
+device_kinds = {0x08: 'boiler', 0x09: 'controller', 0x0B: 'computer', 0x10: 'thermostat', 0x11: 'switch', 0x30: 'solar',
+                0x38: 'heatpump'}
+device_kinds.update({address: 'thermostat' for address in range(0x17, 0x20)})
+device_kinds.update({address: 'mixer' for address in range(0x20, 0x30)})
+
+class Device:
+    """A bus address, what is known about the device there and what it has sent"""
+    __slots__ = ('address', 'name', 'kind', 'telegrams', 'sections')
+
+    def __init__(self, address, name, kind=None):
+        self.address = address
+        self.name = name
+        self.kind = kind
+        self.telegrams = 0
+        self.sections = set()
+
+    def as_dict(self):
+        return({'address': self.address, 'name': self.name, 'kind': self.kind, 'telegrams': self.telegrams,
+                'sections': sorted(list(self.sections))})
+
+# The device registry, indexed by bus address. Source bytes of broken telegrammes may be
+# anything, so all 256 values are covered.
+devices = [Device(address, devicenames.get(address, 'Gerät 0x{:02x}'.format(address)), device_kinds.get(address))
+           for address in range(256)]
+device_names = [device.name for device in devices]
+# Bus addresses per device kind
+DEVICE_ADDRESSES = {}
+for _device in devices:
+    if _device.kind:
+        DEVICE_ADDRESSES.setdefault(_device.kind, []).append(_device.address)
+
+header_struct = struct.Struct('BBBB')
+# Type byte of EMS+ telegrammes. The 16 bit extended type follows the offset, in requests
+# after the requested length.
+EMS_PLUS = 0xff
+extended_type_struct = struct.Struct('>H')
+
+# Last valid complete telegramme per source and message type, keyed by
+# type << 16 | source << 8 | offset, with offset 0. Repeated broadcasts of the same
+# telegramme are neither checked nor decoded again, and partial telegrammes start from
+# the last complete one.
+last_telegrams = {}
+
+# (problem, message name) pairs already logged as a warning. Their repetitions are only
+# counted in statistics and logged at debug level.
+_warned = set()
+
+def warn_once(problem, name, msg, *args):
+    """Log a problem with a message type as a warning the first time, later at debug level"""
+    if (problem, name) in _warned:
+        _LOGGER.debug(msg, *args)
+    else:
+        _warned.add((problem, name))
+        _LOGGER.warning(msg + ' Further ones are counted in the statistics.', *args)
+
+message_counts = {}
+_summary_start = time.monotonic()
+
+def count_message(name):
+    """Count a message for the periodic summary and log the summary when it is due"""
+    global _summary_start
+    message_counts[name] = message_counts.get(name, 0) + 1
+    now = time.monotonic()
+    if now - _summary_start >= summary_interval:
+        _LOGGER.info('Telegrammes in the last %d s: %s', now - _summary_start,
+                     ', '.join('{} {}'.format(k, v) for k, v in sorted(message_counts.items())))
+        message_counts.clear()
+        _summary_start = now
+
+class Histogram:
+    """Latency histogram with fixed buckets. observe() takes seconds."""
+    # Upper bounds of the buckets in seconds. Everything above the last one is only counted.
+    BOUNDS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def as_dict(self):
+        return({
+            'count': self.count,
+            'mean_us': round(self.sum / self.count * 1e6, 1) if self.count else None,
+            'buckets_us': {('{:g}'.format(bound * 1e6) if index < len(self.BOUNDS) else '+Inf'): n
+                           for index, (bound, n) in enumerate(zip(self.BOUNDS + (None,), self.buckets))},
+        })
+
+class Statistics:
+    """Counters of all stages of the driver, from the serial port to the dispatch.
+
+    Counting is a few integer additions per telegramme, so it is always on. Decode and
+    dispatch times are kept per message type.
+    """
+    COUNTERS = ('bytes_read', 'telegrams', 'polls', 'repeated', 'too_short', 'overflows', 'parity_errors',
+                'bad_crc', 'unknown_types', 'length_mismatches', 'decode_errors', 'changes',
+                'event_clients_dropped', 'queue_coalesced', 'queue_dropped', 'partial')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.decode_time = {}
+        self.dispatch_time = {}
+        self.since = time.time()
+
+    @staticmethod
+    def observe(histograms, name, seconds):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def as_dict(self):
+        # Called from the HTTP threads while messages add histograms and device sections,
+        # so these are iterated over copies.
+        result = {name: getattr(self, name) for name in self.COUNTERS}
+        result['since'] = datetime.fromtimestamp(self.since).isoformat()
+        result['decode_time'] = {name: h.as_dict() for name, h in list(self.decode_time.items())}
+        result['dispatch_time'] = {name: h.as_dict() for name, h in list(self.dispatch_time.items())}
+        result['devices'] = [device.as_dict() for device in devices if device.telegrams]
+        return(result)
+
+statistics = Statistics()
+
+class EventClient:
+    """An event stream. None in the queue ends it."""
+    __slots__ = ('queue', 'sections')
+
+    def __init__(self, sections=None, maxsize=None):
+        self.queue = queue.Queue(maxsize or EVENT_QUEUE_SIZE)
+        self.sections = sections
+
+    def close(self):
+        """Drop the pending events and end the stream"""
+        with self.queue.mutex:
+            self.queue.queue.clear()
+        self.queue.put_nowait(None)
+
+class EventBroker:
+    """Hands the changes of the status to the clients of the event stream.
+
+    Every change is serialized once as a server-sent event and put into the bounded
+    queue of each client. A client whose queue is full is dropped instead of slowing
+    down the reader. Without clients, publish() is not even called.
+    """
+    def __init__(self):
+        self.clients = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, sections=None):
+        """Return a new EventClient, receiving the changes of sections or of all sections for None"""
+        client = EventClient(sections)
+        with self._lock:
+            self.clients = self.clients + (client,)
+        return(client)
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self.clients = tuple(c for c in self.clients if c is not client)
+
+    def publish(self, section, changes, version):
+        event = 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            version, section, json.dumps(changes, separators=(',', ':'))).encode('UTF-8')
+        for client in self.clients:
+            if client.sections is not None and section not in client.sections:
+                continue
+            try:
+                client.queue.put_nowait(event)
+            except queue.Full:
+                statistics.event_clients_dropped += 1
+                self.unsubscribe(client)
+                client.close()
+
+    def close(self):
+        """End all event streams"""
+        with self._lock:
+            clients, self.clients = self.clients, ()
+        for client in clients:
+            client.close()
+
+events = EventBroker()
+
+def parse_message(data, callback=None):
+    """Decode a telegramme without the BREAK. data may be bytes or a memoryview.
+
+    callback(section, changes) is called when a message changes the status of a section.
+    changes only contains the values that differ from the previous message.
+    """
     # Polling requests and no data responses
     if len(data) == 1:
-#        if data[0] & 0x80:
-#            print('Master polling {} - {}'.format(data[0] & 0x7f, devicenames[data[0] & 0x7f]))
-#        else:
-#            print('No data from   {} - {}'.format(data[0], devicenames[data[0]]))
+        statistics.polls += 1
         return()
+    statistics.telegrams += 1
 
     if len(data) < 6:
-        print('Message too short: {}'.format(data))
+        statistics.too_short += 1
+        _LOGGER.debug('Message too short: %s', bytes(data).hex())
         return()
 
-    # Print the message
-#    print('       ', end='')
-#    for i in range(len(data)):
-#        print(' {:02d}'.format(i), end='')
-#    print()
-
     # Read the header
-    try:
-        (src, dst, msgtype, offset) = struct.unpack('BBBB', data[0: 4])
-    except Exception as e:
-        print('Unpack failed: {}'.format(e))
-        return()
+    (src, dst, msgtype, offset) = header_struct.unpack_from(data)
     request = bool(dst & 0x80)
     if request:
         dst = dst & 0x7f
-        print('Request  {} ({}) -> {} ({}) type 0x{:02x}, offset {}:'.format(
-            devicenames[src], src, devicenames[dst], dst, msgtype, offset), end='')
-    else:
-        print('Response {} ({}) -> {} ({}) type 0x{:02x}, offset {}:'.format(
-            devicenames[src], src, devicenames[dst], dst, msgtype, offset), end='')
-    for i in range(4, len(data)):
-        print(' {:02x}'.format(data[i]), end='')
-    print()
+    header = 4
+    if msgtype == EMS_PLUS:
+        # EMS+: The extended type makes the id of the message, 0xff0000 | extended type.
+        header = 7 if request else 6
+        if len(data) <= header:
+            statistics.too_short += 1
+            _LOGGER.debug('Message too short: %s', bytes(data).hex())
+            return()
+        msgtype = EMS_PLUS << 16 | extended_type_struct.unpack_from(data, header - 2)[0]
+    debug = _LOGGER.isEnabledFor(logging.DEBUG)
+    if debug:
+        _LOGGER.debug('%s %s (%d) -> %s (%d) type 0x%02x, offset %d: %s',
+                      'Request ' if request else 'Response', device_names[src], src, device_names[dst], dst,
+                      msgtype, offset, ' '.join('{:02x}'.format(b) for b in data[header:]))
+
+    # Fast path: The telegramme repeats the last valid one, so its CRC is fine and nothing changed.
+    key = msgtype << 16 | src << 8 | offset
+    if not request and not printing and last_telegrams.get(key) == data:
+        statistics.repeated += 1
+        devices[src].telegrams += 1
+        return()
 
     # Check CRC
     crc = crc_check(data)
     if not crc:
-        print('Bad CRC')
+        statistics.bad_crc += 1
+        _LOGGER.debug('Bad CRC')
         return()
 
+    device = devices[src]
+    device.telegrams += 1
     if not request:
-        msgdef = next((m for m in messagedefinitions if m['id'] == msgtype), None)
+        msgdef = messagetypes.get(msgtype)
         if msgdef:
-            print(msgdef['name'])
-            if len(data) - 5 != msgdef['len']:
-                print('Wrong message length: {} <-> {}'.format(len(data) - 5, msgdef['len']))
-            if msgdef['format']:
+            name = msgdef['name']
+            if debug:
+                _LOGGER.debug(name)
+            if summary_interval:
+                count_message(name)
+            # Telegrammes with an offset or shorter than the message are partial updates.
+            # EMS+ messages may be longer than their known fields.
+            partial = offset or len(data) < msgdef['size']
+            if offset + len(data) > msgdef['size'] and header == 4:
+                statistics.length_mismatches += 1
+                warn_once('length', name, 'Wrong message length of %s: %d at offset %d <-> %d.',
+                          name, len(data) - 5, offset, msgdef['len'])
+            if partial:
+                # The last complete telegramme is the start of the image. Taking it out of the
+                # cache makes its next repetition undo the patch.
+                full = last_telegrams.pop(key & ~0xff, None)
+            else:
+                last_telegrams[key] = bytes(data)
+            if msgdef['decode']:
+                section = msgdef.get('short')
+                start = time.perf_counter()
                 try:
-                    values = struct.unpack(msgdef['format'], data[4:-1])
+                    if printing and not partial:
+                        print_message(msgdef, msgdef['decode'](data, header))
+                    # Messages without a section are only decoded for printing.
+                    if not section:
+                        changes = None
+                    elif partial:
+                        statistics.partial += 1
+                        record = state.record(msgdef, src)
+                        section = record.section
+                        changes = state.patch(record, msgdef, offset, data[header:-1], full)
+                    else:
+                        record = state.record(msgdef, src)
+                        section = record.section
+                        changes = state.update(record, msgdef, data, header)
                 except Exception as e:
-                    print('Unpack failed: {}'.format(e))
+                    # Decode its repetitions again instead of taking them as unchanged.
+                    last_telegrams.pop(key, None)
+                    statistics.decode_errors += 1
+                    warn_once('decode', name, 'Decoding %s failed: %s.', name, e)
                     return()
-                if msgdef['print']:
-                    data = msgdef['print'](values)
-                    if 'short' in msgdef:
-                        status[msgdef['short']] = data
-                        if hass:
-                            hass.bus.fire('buderus_ems_received_' + msgdef['short'], data)
-                else:
-                    print('Missing print, values: {}'.format(values))
-            else:
-                print('Missing format')
+                decoded = time.perf_counter()
+                Statistics.observe(statistics.decode_time, name, decoded - start)
+                if changes:
+                    statistics.changes += 1
+                    device.sections.add(section)
+                    if events.clients:
+                        events.publish(section, changes, state.version)
+                    if callback:
+                        callback(section, changes)
+                        Statistics.observe(statistics.dispatch_time, name, time.perf_counter() - decoded)
+            elif debug:
+                _LOGGER.debug('No fields defined')
         else:
-            print('Missing definition')
+            statistics.unknown_types += 1
+            if debug:
+                _LOGGER.debug('Missing definition')
+
+class Dispatcher:
+    """Routes changed values to the one target that owns a (section, field) pair.
+
+    A target implements set_value(value), which returns True if its state changed, and
+    write_state(). The states are written after all values of a message have been set.
+    """
+    def __init__(self):
+        self._sections = {}
+
+    def register(self, section, field, target):
+        self._sections.setdefault(section, {})[field] = target
+
+    def unregister(self, section, field):
+        self._sections.get(section, {}).pop(field, None)
+
+    def dispatch(self, section, changes):
+        """Set the changed values and write the states of the affected targets"""
+        targets = self._sections.get(section)
+        if not targets:
+            return()
+        updated = []
+        for field, value in changes.items():
+            target = targets.get(field)
+            if target is not None and target.set_value(value):
+                updated.append(target)
+        for target in updated:
+            target.write_state()
+
+def metric_name(section, name):
+    """Prometheus name of a value, e.g. buderus_ems_uba_fast_flow_temp_is"""
+    return('buderus_ems_{}_{}'.format(section, re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', name).lower()))
+
+def section_metrics(section):
+    """Return (metric name, field name, help) of the numeric values of a section"""
+    metrics = _section_metrics.get(section)
+    if metrics is None:
+        msgdef = messagetypes[state[section].msgtype]
+        metrics = _section_metrics[section] = [
+            (metric_name(section, f['name']), f['name'],
+             '{} ({})'.format(f['description'], f['unit']) if f['unit'] else f['description'] or f['label'] or f['name'])
+            for f in msgdef['fields'] if f['type'] not in ('str2', 'datetime', 'datetime5')]
+    return(metrics)
+
+_section_metrics = {}
+# Rendered parts of /metrics and the version of the data they were rendered from
+_metrics_cache = {'status': (None, b''), 'statistics': (None, b''), 'body': (None, b'')}
+
+def _render_status_metrics():
+    lines = []
+    for section, record in state.records.items():
+        for metric, name, description in section_metrics(section):
+            value = record.get(name)
+            if value is None:
+                continue
+            lines.append('# HELP {} {}\n# TYPE {} gauge\n{} {}\n'.format(
+                metric, description, metric, metric, int(value) if isinstance(value, bool) else value))
+    return(''.join(lines).encode('UTF-8'))
+
+def _render_statistics_metrics():
+    lines = []
+    for name in Statistics.COUNTERS:
+        metric = 'buderus_ems_{}_total'.format(name)
+        lines.append('# TYPE {} counter\n{} {}\n'.format(metric, metric, getattr(statistics, name)))
+    for kind, histograms in (('decode', statistics.decode_time), ('dispatch', statistics.dispatch_time)):
+        metric = 'buderus_ems_{}_seconds'.format(kind)
+        lines.append('# TYPE {} histogram\n'.format(metric))
+        for message, histogram in sorted(list(histograms.items())):
+            cumulative = 0
+            for bound, count in zip(Histogram.BOUNDS + ('+Inf',), histogram.buckets):
+                cumulative += count
+                lines.append('{}_bucket{{message="{}",le="{}"}} {}\n'.format(metric, message, bound, cumulative))
+            lines.append('{}_sum{{message="{}"}} {}\n{}_count{{message="{}"}} {}\n'.format(
+                metric, message, histogram.sum, metric, message, histogram.count))
+    return(''.join(lines).encode('UTF-8'))
+
+def render_metrics():
+    """Return the status values and the driver counters in the Prometheus text format.
+
+    The values are only rendered again when a message has changed the status, the
+    counters when one of them has changed since the last call. The histograms only
+    change with the telegramme counter.
+    """
+    versions = (state.version, statistics.since) + tuple(getattr(statistics, name) for name in Statistics.COUNTERS)
+    if _metrics_cache['body'][0] != versions:
+        for part, version, render in (('status', versions[0], _render_status_metrics),
+                                      ('statistics', versions[1:], _render_statistics_metrics)):
+            if _metrics_cache[part][0] != version:
+                _metrics_cache[part] = (version, render())
+        _metrics_cache['body'] = (versions, _metrics_cache['status'][1] + _metrics_cache['statistics'][1])
+    return(_metrics_cache['body'][1])
+
+class Snapshot:
+    """The JSON of the status or a section at one version. It is never changed after creation."""
+    __slots__ = ('version', 'body', 'etag', 'modified', '_gzipped')
+
+    def __init__(self, version, body, etag, modified):
+        self.version = version
+        self.body = body
+        self.etag = etag
+        self.modified = modified
+        self._gzipped = None
+
+    def gzipped(self):
+        """The body compressed with gzip, compressed on first use"""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, 6)
+        return(self._gzipped)
+
+# ETags must differ from those of earlier runs, whose versions started at 0 as well.
+_snapshot_epoch = '{:x}'.format(int(time.time()))
+# Latest snapshot per section, None for the whole status
+_snapshots = {}
+
+def status_snapshot(section=None):
+    """Return the Snapshot of a section, or of the whole status for None.
+
+    The JSON is only serialized again after the section has changed. Raises KeyError for
+    an unknown section.
+    """
+    if section is None:
+        version, modified = state.version, state.epoch
+    else:
+        record = state[section]
+        version, modified = record.version, record.epoch or state.epoch
+    snapshot = _snapshots.get(section)
+    if snapshot is not None and snapshot.version == version:
+        return(snapshot)
+    if section is None:
+        body = b'{' + b','.join(json.dumps(name).encode('UTF-8') + b':' + status_snapshot(name).body
+                                for name in state) + b'}'
+    else:
+        version, values = state.section_dict(section)
+        modified = record.epoch or state.epoch
+        body = json.dumps(values, separators=(',', ':')).encode('UTF-8')
+    snapshot = Snapshot(version, body, '"{}-{}-{}"'.format(_snapshot_epoch, section or 'status', version), modified)
+    _snapshots[section] = snapshot
+    return(snapshot)
+
+def accepts_encoding(header, coding):
+    """Whether an Accept-Encoding header accepts a content coding, with a q-value above 0"""
+    accepted = False
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if name not in (coding, '*'):
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == coding:
+            # The coding itself takes precedence over *.
+            return(q > 0)
+        accepted = q > 0
+    return(accepted)
 
 # Start HTTP Server
 class EMSHTTPHandler(BaseHTTPRequestHandler):
+    # Keep-alive, every response has a Content-Length.
+    protocol_version = 'HTTP/1.1'
+    timeout = HTTP_TIMEOUT
+    # Buffer the writes, so headers and body leave in one segment and do not wait for
+    # the delayed ACK of the client. The buffer is flushed after every request.
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(s, format, *args):
+        _LOGGER.debug('HTTP %s: %s', s.address_string(), format % args)
+
     def do_HEAD(s):
-        s.send_response(200)
-        s.send_header("Content-type", "text/html")
-        s.end_headers()
+        s.respond(head=True)
+
     def do_GET(s):
+        s.respond()
+
+    def respond(s, head=False):
+        headers = {}
         if s.path == '' or s.path == '/':
             response = (200, 'text/plain', b'foobar')
-        elif s.path == '/status':
+        elif s.path == '/metrics':
+            response = (200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics())
+        elif s.path == '/statistics':
+            response = (200, 'application/json', json.dumps(statistics.as_dict(), indent=4).encode('UTF-8'))
+        elif s.path == '/events' or s.path.startswith('/events/'):
+            s.stream_events(s.path[8:] or None, head)
+            return()
+        elif s.path == '/status' or s.path.startswith('/status/'):
             try:
-                response = (200, 'application/json', json.dumps(status, indent=4).encode('UTF-8'))
+                snapshot = status_snapshot(s.path[8:] or None)
+            except KeyError:
+                response = (404, 'text/plain', b'Section not found')
             except Exception as e:
                 response = (500, 'text/plain', ('Cannot create JSON: {}'.format(e)).encode('UTF-8'))
+            else:
+                # The gzip body is another representation, so it gets an ETag of its own.
+                compress = accepts_encoding(s.headers.get('Accept-Encoding', ''), 'gzip')
+                etag = snapshot.etag[:-1] + '-gz"' if compress else snapshot.etag
+                headers['ETag'] = etag
+                headers['Last-Modified'] = formatdate(snapshot.modified, usegmt=True)
+                headers['Cache-Control'] = 'no-cache'
+                headers['Vary'] = 'Accept-Encoding'
+                if s.not_modified(snapshot, etag):
+                    response = (304, None, b'')
+                elif compress:
+                    headers['Content-Encoding'] = 'gzip'
+                    response = (200, 'application/json', snapshot.gzipped())
+                else:
+                    response = (200, 'application/json', snapshot.body)
         else:
             response = (404, 'text/plain', b'Path not found')
         s.send_response(response[0])
-        s.send_header('Content-type', response[1])
+        if response[1]:
+            s.send_header('Content-type', response[1])
+        if response[0] != 304:
+            s.send_header('Content-Length', str(len(response[2])))
+        for name, value in headers.items():
+            s.send_header(name, value)
         s.end_headers()
-        s.wfile.write(response[2])
-def start_server():
-    print('Starting HTTP server on port {}'.format(HTTP_PORT))
-    httpd = HTTPServer(('localhost', HTTP_PORT), EMSHTTPHandler)
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    print('Ending HTTP server on port {}'.format(HTTP_PORT))
-    httpd.server_close()
+        if not head:
+            s.wfile.write(response[2])
+
+    def stream_events(s, section=None, head=False):
+        """Send the current status, then every change as a server-sent event, until the client goes away.
+
+        For head, only the headers are sent.
+        """
+        if section is not None and section not in state:
+            s.send_error(404, 'Section not found')
+            return()
+        # The stream has no length, so the connection ends with it.
+        s.close_connection = True
+        s.send_response(200)
+        s.send_header('Content-type', 'text/event-stream; charset=utf-8')
+        s.send_header('Cache-Control', 'no-cache')
+        s.send_header('Connection', 'close')
+        s.end_headers()
+        if head:
+            return()
+        client = events.subscribe(None if section is None else {section})
+        try:
+            snapshot = status_snapshot(section)
+            s.wfile.write(b'id: %d\nevent: status\ndata: %s\n\n' % (snapshot.version, snapshot.body))
+            s.wfile.flush()
+            while True:
+                try:
+                    event = client.queue.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    event = b': keepalive\n\n'
+                if event is None:
+                    break
+                s.wfile.write(event)
+                s.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            events.unsubscribe(client)
 
-def start_http_server():
-    daemon = threading.Thread(name='daemon_server', target=start_server)
-    daemon.setDaemon(True) # Set as a daemon so it will be killed once the main thread is dead.
+    def not_modified(s, snapshot, etag):
+        """Check the conditional headers of the request against a snapshot sent with etag"""
+        etags = s.headers.get('If-None-Match')
+        if etags is not None:
+            return(etags.strip() == '*' or etag in (tag.strip() for tag in etags.split(',')))
+        since = s.headers.get('If-Modified-Since')
+        if since is not None:
+            try:
+                return(int(snapshot.modified) <= parsedate_to_datetime(since).timestamp())
+            except (TypeError, ValueError):
+                pass
+        return(False)
+
+class EMSHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves every connection in its own thread, so a slow client does not hold up the others"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_http_server(host=HTTP_HOST, port=HTTP_PORT):
+    """Start the HTTP server in a daemon thread and return it. Stop it with stop_http_server()."""
+    httpd = EMSHTTPServer((host, port), EMSHTTPHandler)
+    daemon = threading.Thread(name='ems_http_server', target=httpd.serve_forever, daemon=True)
     daemon.start()
+    _LOGGER.info('HTTP server listening on %s port %d', host, port)
+    return(httpd)
 
-def mainloop(port, hass):
-    telegram = b''
-    parity_errors = False
-    parity = 0
-    while 1:
-        char = os.read(port, 1)
-        if len(char) != 1:
-            continue
-        if parity == 0 and char == b'\xff':
-            # We got a parity mark charater.
-            parity = 1
-            continue
-        elif parity == 1:
-            # Character after parity mark
-            if char == b'\x00':
-                # Parity error or break signal
-                parity = 2
-            elif char == b'\xff':
-                telegram += b'\xff'
-                parity = 0
-            else:
-                print('Wrong character after parity mark ignored.')
-                parity = 0
-            continue
-        elif parity == 2:
-            # 2nd character after parity mark
-            if char == b'\x00':
-                # Break signal. The message is complete.
-                parse_message(telegram, hass)
-                telegram = b''
-                parity_errors = False
-                parity = 0
+def stop_http_server(httpd):
+    """Stop accepting connections, end the event streams and close the socket.
+
+    Other open connections end with their threads.
+    """
+    httpd.shutdown()
+    events.close()
+    httpd.server_close()
+    _LOGGER.info('HTTP server on %s port %d stopped', *httpd.server_address[:2])
+
+class Framer:
+    """Splits the parity marked byte stream of the serial port into telegrammes.
+
+    With PARMRK, a BREAK is read as \\xff\\x00\\x00, a character with a parity error as
+    \\xff\\x00<char> and a literal 0xff as \\xff\\xff. The state is kept between calls to
+    feed(), so these sequences may be split across reads.
+
+    The telegramme is assembled in a preallocated buffer. The callback gets a memoryview
+    into it, which is only valid until the callback returns. Copy it to keep it.
+    """
+    def __init__(self, callback, size=MAX_TELEGRAM):
+        self.callback = callback
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.overflow = False
+        self.parity_errors = False
+        self.parity = 0
+
+    def _append(self, data):
+        length = self.length + len(data)
+        if length > len(self.buffer):
+            self.overflow = True
+            return()
+        self.buffer[self.length:length] = data
+        self.length = length
+
+    def feed(self, chunk):
+        """Process a chunk of bytes and call back for every completed telegramme"""
+        statistics.bytes_read += len(chunk)
+        chunk_view = memoryview(chunk)
+        pos = 0
+        end = len(chunk)
+        while pos < end:
+            if self.parity == 0:
+                # Copy everything up to the next parity mark in one go.
+                mark = chunk.find(b'\xff', pos)
+                if mark < 0:
+                    self._append(chunk_view[pos:])
+                    return()
+                if mark > pos:
+                    self._append(chunk_view[pos:mark])
+                # We got a parity mark charater.
+                self.parity = 1
+                pos = mark + 1
                 continue
+            char = chunk[pos]
+            pos += 1
+            if self.parity == 1:
+                # Character after parity mark
+                if char == 0x00:
+                    # Parity error or break signal
+                    self.parity = 2
+                elif char == 0xff:
+                    self._append(b'\xff')
+                    self.parity = 0
+                else:
+                    _LOGGER.debug('Wrong character after parity mark ignored.')
+                    self.parity = 0
             else:
-                # Save the error but yet add the character.
-                parity_errors = True
-        telegram += char
+                # 2nd character after parity mark
+                if char == 0x00:
+                    # Break signal. The message is complete.
+                    if self.parity_errors:
+                        statistics.parity_errors += 1
+                    if self.overflow:
+                        statistics.overflows += 1
+                        _LOGGER.warning('Telegramme longer than %d bytes dropped.', len(self.buffer))
+                    else:
+                        self.callback(self.view[:self.length], self.parity_errors)
+                    self.length = 0
+                    self.overflow = False
+                    self.parity_errors = False
+                    self.parity = 0
+                else:
+                    # Save the error but yet add the character.
+                    self.parity_errors = True
+                    self._append(chunk_view[pos - 1:pos])
+                    self.parity = 0
+
+def escape_telegram(telegram, parity_errors=False):
+    """Return a telegramme as the serial port delivers it with PARMRK, including the BREAK.
+
+    With parity_errors, its first byte other than 0 is marked as received with a parity
+    error. A marked 0 would read as a BREAK.
+    """
+    telegram = bytes(telegram)
+    if parity_errors:
+        pos = len(telegram) - len(telegram.lstrip(b'\x00'))
+        if pos < len(telegram):
+            return(escape_telegram(telegram[:pos])[:-3] + b'\xff\x00' + telegram[pos:pos + 1] +
+                   escape_telegram(telegram[pos + 1:]))
+    return(telegram.replace(b'\xff', b'\xff\xff') + b'\xff\x00\x00')
+
+class TelegramQueue:
+    """Bounded queue of telegrammes between the reader thread and the decoder.
+
+    put() never blocks; it applies the overflow policy instead and counts what it drops
+    in statistics. With 'coalesce', a telegramme replaces a waiting one with the same
+    header (source, destination, type and offset, and the extended type of EMS+), as only the
+    latest values matter.
+    """
+    def __init__(self, maxsize=QUEUE_SIZE, overflow='coalesce'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {}'.format(overflow))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._lock = threading.Lock()
+        self._items = OrderedDict() if overflow == 'coalesce' else deque()
+        self.peak = 0
+
+    def __len__(self):
+        return(len(self._items))
+
+    def put(self, telegram):
+        """Queue a copy of telegram. Returns True if the queue was empty before."""
+        telegram = bytes(telegram)
+        with self._lock:
+            items = self._items
+            was_empty = not items
+            if self.overflow == 'coalesce':
+                key = telegram[:6] if telegram[2:3] == b'\xff' else telegram[:4]
+                if key in items:
+                    # The replacement is the newest, so it is drained after the telegrammes
+                    # that arrived before it, e.g. partial ones of the same message.
+                    items.move_to_end(key)
+                    statistics.queue_coalesced += 1
+                elif len(items) >= self.maxsize:
+                    items.popitem(last=False)
+                    statistics.queue_dropped += 1
+                items[key] = telegram
+            elif len(items) < self.maxsize:
+                items.append(telegram)
+            elif self.overflow == 'drop_oldest':
+                items.popleft()
+                items.append(telegram)
+                statistics.queue_dropped += 1
+            else:
+                statistics.queue_dropped += 1
+            self.peak = max(self.peak, len(items))
+        return(was_empty)
+
+    def drain(self):
+        """Remove and return all waiting telegrammes, oldest first"""
+        with self._lock:
+            if self.overflow == 'coalesce':
+                telegrams = list(self._items.values())
+            else:
+                telegrams = list(self._items)
+            self._items.clear()
+        return(telegrams)
+
+class Reader(threading.Thread):
+    """Reads and frames the serial port in its own thread and queues the telegrammes.
+
+    notify() is called from the thread when a telegramme arrives in an empty queue. The
+    decoding happens wherever the queue is drained, so a busy consumer cannot stall the
+    reading. Polls are only counted. Every telegramme is written to capture, if given.
+    """
+    def __init__(self, port, telegram_queue, notify, capture=None, read_size=READ_SIZE):
+        super().__init__(name='ems_reader', daemon=True)
+        self.port = port
+        self.queue = telegram_queue
+        self.notify = notify
+        self.capture = capture
+        self.read_size = read_size
+        self.error = None
+        self._stopped = threading.Event()
+        self._framer = Framer(self._handle_telegram)
+
+    def _handle_telegram(self, telegram, parity_errors):
+        if self.capture:
+            self.capture.write(telegram, parity_errors)
+        if len(telegram) == 1:
+            statistics.polls += 1
+        elif self.queue.put(telegram):
+            self.notify()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                if select.select((self.port,), (), (), READER_POLL)[0]:
+                    chunk = os.read(self.port, self.read_size)
+                    if chunk:
+                        self._framer.feed(chunk)
+        except (OSError, ValueError) as e:
+            if not self._stopped.is_set():
+                self.error = e
+                _LOGGER.error('Reading from the serial port failed: %s', e)
+
+    def stop(self):
+        """Ask the thread to end. It does within READER_POLL seconds."""
+        self._stopped.set()
+
+def mainloop(port, callback=None, read_size=READ_SIZE, capture=None):
+    """Read and decode telegrammes forever. Each telegramme is written to capture, if given."""
+    def handle_telegram(telegram, parity_errors):
+        if capture:
+            capture.write(telegram, parity_errors)
+        parse_message(telegram, callback)
+
+    framer = Framer(handle_telegram)
+    while 1:
+        chunk = os.read(port, read_size)
+        if chunk:
+            framer.feed(chunk)
 
 if __name__ == '__main__':
-    #global printing
-    #printing = True
-    start_http_server()
-    port = open_serial(SERIAL_PORT)
-    mainloop(port, None)
+    import argparse
+    parser = argparse.ArgumentParser(description='Read and decode the EMS bus, serving the values over HTTP')
+    parser.add_argument('device', nargs='?', default=SERIAL_PORT)
+    parser.add_argument('--host', default=HTTP_HOST, help='Address the HTTP server binds to')
+    parser.add_argument('--port', type=int, default=HTTP_PORT, help='Port of the HTTP server')
+    parser.add_argument('--print', action='store_true', help='Print the decoded values')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    printing = args.print
+    httpd = start_http_server(args.host, args.port)
+    try:
+        mainloop(open_serial(args.device), None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_http_server(httpd)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# EMS bus simulator on a pseudo terminal, a stand-in for the heating unit.
+#
+# The boiler (0x08) and an RC35 (0x10) broadcast their monitor messages on the usual
+# schedule, and the master polls the bus in between. A pseudo terminal cannot carry a
+# BREAK, so the simulator writes the stream as a serial port with PARMRK delivers it, and
+# ems.open_serial() turns off PARMRK for pseudo terminals. Like the bus, the simulator
+# never waits for the reader: what does not fit into the pseudo terminal is dropped.
+#
+# Usage from the component folder:
+#   python3 simulator.py --link /tmp/ttyEMS [--speed 10] [--duration 3600] [--decode]
+# and point the integration, capture.py or ems.py to /tmp/ttyEMS.
+
+import argparse
+import heapq
+import math
+import os
+import pty
+import random
+import threading
+import time
+import tty
+from datetime import datetime, timedelta
+
+try:
+    from . import ems
+except ImportError:
+    import ems
+
+BOILER = 0x08
+THERMOSTAT = 0x10
+# The master polls another address every POLL_INTERVAL seconds of bus time.
+POLL_INTERVAL = 0.02
+POLLED_ADDRESSES = (0x08, 0x09, 0x0b, 0x10, 0x11, 0x17, 0x20, 0x21, 0x28)
+# Bus time is written in slices of at most WRITE_INTERVAL seconds of real time.
+WRITE_INTERVAL = 0.05
+
+class HeatingModel:
+    """Produces plausible values of a boiler with one heating circuit over bus time"""
+    def __init__(self, seed=None):
+        self.rnd = random.Random(seed)
+        self.start = datetime.now().replace(microsecond=0)
+        self.burner_starts = 12345
+        self.burner_minutes = 234567
+        self.burning = False
+
+    def burner_on(self, t):
+        # The burner runs 8 of every 20 minutes.
+        return(t % 1200 < 480)
+
+    def flow_temperature(self, t):
+        return(48 + 10 * math.sin(t / 1200 * 2 * math.pi))
+
+    def noise(self, amount=0.1):
+        return(self.rnd.choice((-amount, 0, 0, amount)))
+
+    def uba_fast(self, t):
+        burning = self.burner_on(t)
+        if burning and not self.burning:
+            self.burner_starts += 1
+        self.burning = burning
+        return({
+            'flowTempSet': 60, 'flowTempIs': round(self.flow_temperature(t) + self.noise(), 1),
+            'burnPowSet': 75, 'burnPowIs': 42 if burning else 0,
+            'gasValve1': burning, 'fan': burning, 'boilerPump': True,
+            'boilerTemp': None, 'drinkWaterTemp': round(45 + self.noise(), 1),
+            'flowReturnTemp': round(self.flow_temperature(t) - 12 + self.noise(), 1),
+            'flameCurrent': round(7.5 + self.noise(0.2), 1) if burning else 0,
+            'systemPressure': 1.6, 'serviceCode': '-H' if burning else '0H', 'errorCode': 200,
+            'intakeTemp': round(12 + self.noise(), 1),
+        })
+
+    def uba_slow(self, t):
+        return({
+            'outsideTemp': round(5 + 3 * math.sin(t / 86400 * 2 * math.pi), 1), 'boilerTemp': None,
+            'exhaustTemp': round(self.flow_temperature(t) + 10 + self.noise(), 1), 'pumpMod': 60,
+            'burnStarts': self.burner_starts, 'burnOperTot': self.burner_minutes + int(t // 150),
+            'burnOperStage2': 0, 'burnOperHeat': self.burner_minutes + int(t // 180), 'burnOperDrinkWater': 23456,
+        })
+
+    def uba_dw(self, t):
+        return({
+            'tempSet': 50, 'sensor1tempIs': round(48 + self.noise(), 1), 'sensor2TempIs': round(47 + self.noise(), 1),
+            'dayMode': True, 'heatingEnabled': True, 'setTempReached': True, 'circDayMode': True,
+            'systemType': 3, 'currentFlow': 0, 'heatingTime': 34567, 'heatingRuns': 4567,
+        })
+
+    def uba_setvalues(self, t):
+        return({'boilerTempSet': 60, 'requestedPowerHeating': 100, 'requestedPowerDrinkwater': 0})
+
+    def hk1(self, t):
+        return({
+            'automatic': True, 'dayMode': True, 'roomTempSet': 21, 'roomTempIs': None,
+            'heatingCurve10Deg': 40, 'heatingCurve0Deg': 55, 'heatingCurveMinus10Deg': 70,
+            'requestedBoilerPower': 100, 'calculatedForwardTemp': 58,
+        })
+
+    def rc_time(self, t):
+        now = self.start + timedelta(seconds=int(t))
+        return({'time': now, 'dayOfWeek': now.weekday(), 'clockRunning': True})
+
+    def rc_outdoortemp(self, t):
+        return({'dampedOutdoorTemp': 5})
+
+    def uba_devices(self, t):
+        # Bit n stands for bus address n + 8.
+        return({'device{:02d}'.format(address - 8): True for address in (BOILER, THERMOSTAT)})
+
+# Source, destination, type, interval in seconds and the value function of the model
+SCHEDULE = [
+    (BOILER, 0x00, 0x18, 10, HeatingModel.uba_fast),
+    (BOILER, 0x00, 0x19, 60, HeatingModel.uba_slow),
+    (BOILER, 0x00, 0x34, 30, HeatingModel.uba_dw),
+    (BOILER, 0x0b, 0x07, 300, HeatingModel.uba_devices),
+    (THERMOSTAT, BOILER, 0x1a, 60, HeatingModel.uba_setvalues),
+    (THERMOSTAT, 0x00, 0x3e, 30, HeatingModel.hk1),
+    (THERMOSTAT, 0x00, 0x06, 60, HeatingModel.rc_time),
+    (THERMOSTAT, 0x00, 0xa3, 60, HeatingModel.rc_outdoortemp),
+]
+
+class Simulator:
+    """Writes the bus traffic to the master side of a pseudo terminal.
+
+    speed > 1 runs the schedule faster than real time. The slave side path is in
+    self.path, or in link if one is given. Telegrammes and polls which do not fit into
+    the pseudo terminal, because no one reads it or the reader is too slow, are counted
+    in self.dropped.
+    """
+    def __init__(self, speed=1.0, link=None, seed=None):
+        self.speed = speed
+        self.model = HeatingModel(seed)
+        self.master, self.slave = pty.openpty()
+        # Raw, so nothing is echoed or held back for a line before a reader opens the port
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+        self.telegrams = 0
+        self.polls = 0
+        self.dropped = 0
+        # Rest of a partly written telegramme, written before anything else
+        self.pending = b''
+        self.stopped = threading.Event()
+
+    def close(self):
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self, duration=None):
+        """Write the traffic until duration seconds of bus time have passed or stop() is called"""
+        # Events: due time in bus seconds, schedule index
+        events = [(0.0, index) for index in range(len(SCHEDULE))]
+        heapq.heapify(events)
+        step = max(POLL_INTERVAL, WRITE_INTERVAL * self.speed)
+        bus_time = 0.0
+        next_poll = 0.0
+        start = time.monotonic()
+        while not self.stopped.is_set() and (duration is None or bus_time < duration):
+            bus_time += step
+            out = []
+            # Telegrammes and polls in the order of their due time
+            while events and events[0][0] <= bus_time:
+                due, index = heapq.heappop(events)
+                while next_poll < due:
+                    out.append(self.poll())
+                    next_poll += POLL_INTERVAL
+                src, dst, msgtype, interval, values = SCHEDULE[index]
+                msgdef = ems.messagetypes[msgtype]
+                payload = ems.encode_payload(msgdef, values(self.model, due))
+                out.append(ems.escape_telegram(ems.build_telegram(src, dst, msgtype, payload)))
+                self.telegrams += 1
+                heapq.heappush(events, (due + interval, index))
+            while next_poll < bus_time:
+                out.append(self.poll())
+                next_poll += POLL_INTERVAL
+
+            delay = start + bus_time / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.write(out)
+
+    def write(self, out):
+        """Write the escaped telegrammes and polls of out without blocking"""
+        if self.pending:
+            self.pending = self.pending[self._write(self.pending):]
+            if self.pending:
+                self.dropped += len(out)
+                return()
+        for index, data in enumerate(out):
+            written = self._write(data)
+            if written < len(data):
+                # Whole telegrammes are dropped, a started one is finished later.
+                self.pending = data[written:] if written else b''
+                self.dropped += len(out) - index - (1 if written else 0)
+                return()
+
+    def _write(self, data):
+        try:
+            return(os.write(self.master, data))
+        except BlockingIOError:
+            return(0)
+
+    def poll(self):
+        address = POLLED_ADDRESSES[self.polls % len(POLLED_ADDRESSES)]
+        self.polls += 1
+        return(ems.escape_telegram(bytes((address | 0x80,))))
+
+    def stop(self):
+        self.stopped.set()
+
+class TelegramCounter:
+    """Counts the telegrammes framed by ems.mainloop(), passed to it as its capture"""
+    def __init__(self):
+        self.telegrams = 0
+        self.polls = 0
+
+    def write(self, telegram, parity_errors=False):
+        if len(telegram) == 1:
+            self.polls += 1
+        else:
+            self.telegrams += 1
+
+def decode(path, counter):
+    """Run ems.mainloop() on the slave side until the simulator closes the pseudo terminal"""
+    try:
+        ems.mainloop(ems.open_serial(path), capture=counter)
+    except OSError:
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate an EMS bus on a pseudo terminal')
+    parser.add_argument('--speed', type=float, default=1.0, help='Run the schedule this many times faster')
+    parser.add_argument('--duration', type=float, help='Stop after this many seconds of bus time')
+    parser.add_argument('--link', help='Symlink to create for the simulated serial port')
+    parser.add_argument('--seed', type=int, help='Seed of the value noise')
+    parser.add_argument('--decode', action='store_true', help='Read and decode the bus in this process')
+    args = parser.parse_args()
+
+    simulator = Simulator(args.speed, args.link, args.seed)
+    print('Simulated EMS bus on {}{}'.format(args.link + ' -> ' if args.link else '', simulator.path))
+    counter = None
+    if args.decode:
+        counter = TelegramCounter()
+        reader = threading.Thread(target=decode, args=(simulator.path, counter), daemon=True)
+        reader.start()
+    start = time.process_time()
+    wall = time.monotonic()
+    try:
+        simulator.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    time.sleep(0.5)
+    print('Sent {} telegrammes and {} polls in {:.1f} s, dropped {} of them'.format(
+        simulator.telegrams, simulator.polls, time.monotonic() - wall, simulator.dropped))
+    if counter:
+        print('Framed {} telegrammes and {} polls, {:.2f} s CPU'.format(
+            counter.telegrams, counter.polls, time.process_time() - start))
+    simulator.close()